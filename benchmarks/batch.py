@@ -0,0 +1,49 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2024 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the MIT license.
+
+"""
+Measures how dumps_batch() scales with the number of worker processes.
+Run from the top-level source directory with:
+
+    python -m benchmarks.batch [COUNT]
+"""
+
+import hipack
+import os
+import sys
+import time
+
+
+def make_messages(count):
+    return [{
+        "id": i,
+        "host": u"host-%d.example.com" % (i % 97),
+        "level": u"error" if i % 13 == 0 else u"info",
+        "values": [i * 0.5, i, -i],
+        "tags": {"region": u"eu-west", "shard": i % 8},
+    } for i in range(count)]
+
+
+def main(count=100000):
+    messages = make_messages(count)
+    workers = 1
+    baseline = None
+    while workers <= (os.cpu_count() or 1):
+        start = time.perf_counter()
+        data = hipack.dumps_batch(messages, workers=workers, chunksize=512)
+        elapsed = time.perf_counter() - start
+        if baseline is None:
+            baseline = elapsed
+        print("workers: {:3d}  {:9.1f} msg/s  {:7.2f} MB/s  speedup: {:.2f}x"
+              .format(workers, count / elapsed, len(data) / elapsed / 1e6,
+                      baseline / elapsed))
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
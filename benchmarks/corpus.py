@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2024 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the MIT license.
+
+"""
+Generates synthetic HiPack documents of configurable size and shape, to be
+used as benchmark input. The shapes are:
+
+* ``wide``: a single message with many keys, each holding a small dict.
+* ``deep``: a single message with many deeply nested dicts and lists.
+* ``strings``: a single message with lists of long strings, some of them
+  containing characters which need escaping.
+* ``numbers``: a single message with lists of integers and floats.
+* ``framed``: many small framed messages, like a log file.
+
+Generated values only use types which can be represented in JSON as well,
+so the same data can be used to compare with the ``json`` module. Run from
+the top-level source directory with:
+
+    python -m benchmarks.corpus SHAPE SIZE > output.hi
+"""
+
+import hipack
+import random
+import sys
+
+
+SHAPES = ("wide", "deep", "strings", "numbers", "framed")
+
+_WORDS = (u"alpha", u"bravo", u"charlie", u"delta", u"echo", u"foxtrot",
+          u"Trømso", u"Güedángaños", u"☺", u"quote\"d", u"tab\tbed")
+
+
+def _word(rng):
+    return rng.choice(_WORDS)
+
+
+def _wide(rng, size):
+    return {"key-%d" % i: {"name": _word(rng), "id": i,
+                           "enabled": rng.random() < 0.5}
+            for i in range(size)}
+
+
+def _deep(rng, size, depth=40):
+    result = {}
+    for i in range(max(1, size // depth)):
+        value = rng.randint(0, 1000)
+        for level in range(depth):
+            value = [value, level] if level % 2 else {"n%d" % level: value}
+        result["tree-%d" % i] = value
+    return result
+
+
+def _strings(rng, size):
+    return {"text-%d" % i: [u" ".join(_word(rng) for _ in range(20))
+                            for _ in range(10)]
+            for i in range(max(1, size // 10))}
+
+
+def _numbers(rng, size):
+    return {"series-%d" % i: [rng.randint(-10**9, 10**9)
+                              if j % 2 else rng.uniform(-1e6, 1e6)
+                              for j in range(50)]
+            for i in range(max(1, size // 50))}
+
+
+def _framed(rng, size):
+    return [{"ts": 1700000000 + i,
+             "host": u"host-%d" % rng.randint(0, 50),
+             "level": rng.choice((u"info", u"warning", u"error")),
+             "message": u" ".join(_word(rng) for _ in range(8)),
+             "latency": rng.uniform(0, 2)}
+            for i in range(size)]
+
+
+def generate(shape, size, seed=0):
+    """
+    Returns a message of the given shape, with roughly `size` items. For
+    the ``framed`` shape, a list of messages is returned instead.
+    """
+    rng = random.Random(seed)
+    return globals()["_" + shape](rng, size)
+
+
+def encode(shape, data, indent=True):
+    """
+    Serializes the result of :func:`generate()` as HiPack.
+    """
+    if shape == "framed":
+        return b"".join(hipack.dumps(message, indent, framed=True)
+                        for message in data)
+    return hipack.dumps(data, indent)
+
+
+def main(shape, size, seed=0):
+    if shape not in SHAPES:
+        raise SystemExit("No such shape: " + shape)
+    sys.stdout.buffer.write(encode(shape, generate(shape, int(size),
+                                                   int(seed))))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,42 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2024 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the MIT license.
+
+"""
+Measures the round-trip cost of string values through dumps() and loads(),
+for strings which need escaping and strings which take the fast path.
+Run from the top-level source directory with:
+
+    python -m benchmarks.escape
+"""
+
+import hipack
+import timeit
+
+
+inputs = {
+    "plain": {"s%d" % i: u"plain string value number %d" % i
+              for i in range(100)},
+    "escaped": {"s%d" % i: u"tab\there \"quoted\" back\\slash\nline %d" % i
+                for i in range(100)},
+    "unicode": {"s%d" % i: u"Trømso → Güedángaños ☺ %d" % i
+                for i in range(100)},
+}
+
+
+def main(number=200):
+    for name, obj in sorted(inputs.items()):
+        data = hipack.dumps(obj)
+        assert hipack.loads(data) == obj, "round-trip failed for " + name
+        dump_time = timeit.timeit(lambda: hipack.dumps(obj), number=number)
+        load_time = timeit.timeit(lambda: hipack.loads(data), number=number)
+        print("{:10s} dumps: {:8.1f} ops/s   loads: {:8.1f} ops/s".format(
+            name, number / dump_time, number / load_time))
+
+
+if __name__ == "__main__":
+    main()
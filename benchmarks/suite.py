@@ -0,0 +1,180 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2024 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the MIT license.
+
+"""
+Benchmark suite for the hipack module. The ``run`` command measures the
+throughput and peak memory usage of parsing and serializing documents from
+the synthetic corpus (see ``benchmarks/corpus.py``), along with the ``json``
+module on the same data for comparison, and saves the results to a JSON
+file. The ``compare`` command checks the results of two runs, and exits with
+a non-zero status if any benchmark got slower beyond a threshold. Run from
+the top-level source directory with:
+
+    python -m benchmarks.suite run --size 1000 -o results.json
+    python -m benchmarks.suite compare baseline.json results.json
+
+Standalone benchmarks for specific features are available as well, see
+``benchmarks/escape.py`` and ``benchmarks/batch.py``.
+"""
+
+import argparse
+import hipack
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+from benchmarks import corpus
+
+
+def _measure(func, min_time):
+    # Run at least once, and keep going until min_time has passed.
+    count, start = 0, time.perf_counter()
+    while True:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return count / elapsed
+
+
+def _peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _cases(shape, size):
+    data = corpus.generate(shape, size)
+    hipack_data = corpus.encode(shape, data)
+
+    if shape == "framed":
+        json_data = b"".join(json.dumps(m).encode("utf-8") + b"\n"
+                             for m in data)
+        yield ("hipack.messages", len(hipack_data),
+               lambda: list(hipack.Parser(BytesIO(hipack_data)).messages()))
+        yield ("hipack.dumps", len(hipack_data),
+               lambda: [hipack.dumps(m, framed=True) for m in data])
+        yield ("json.loads", len(json_data),
+               lambda: [json.loads(line)
+                        for line in json_data.splitlines()])
+        yield ("json.dumps", len(json_data),
+               lambda: [json.dumps(m) for m in data])
+        return
+
+    json_data = json.dumps(data, indent=2).encode("utf-8")
+    yield ("hipack.load", len(hipack_data),
+           lambda: hipack.load(BytesIO(hipack_data)))
+    yield ("hipack.loads", len(hipack_data),
+           lambda: hipack.loads(hipack_data))
+    yield ("hipack.dump", len(hipack_data),
+           lambda: hipack.dump(data, BytesIO()))
+    yield ("hipack.dumps", len(hipack_data),
+           lambda: hipack.dumps(data))
+    yield ("json.load", len(json_data),
+           lambda: json.load(BytesIO(json_data)))
+    yield ("json.loads", len(json_data),
+           lambda: json.loads(json_data))
+    yield ("json.dumps", len(json_data),
+           lambda: json.dumps(data, indent=2))
+
+
+def run(args):
+    results = []
+    for shape in args.shapes:
+        for name, nbytes, func in _cases(shape, args.size):
+            ops = _measure(func, args.min_time)
+            result = {
+                "name": shape + "/" + name,
+                "bytes": nbytes,
+                "ops_per_sec": ops,
+                "mb_per_sec": ops * nbytes / 1e6,
+                "peak_memory": _peak_memory(func),
+            }
+            results.append(result)
+            print("{name:28s} {ops_per_sec:10.2f} ops/s "
+                  "{mb_per_sec:8.3f} MB/s {peak_memory:12d} B peak"
+                  .format(**result), file=sys.stderr)
+
+    output = {
+        "hipack_version": hipack.__version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "size": args.size,
+        "results": results,
+    }
+    if args.output == "-":
+        json.dump(output, sys.stdout, indent=2)
+    else:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = dict((r["name"], r) for r in json.load(f)["results"])
+    with open(args.current) as f:
+        current = json.load(f)["results"]
+
+    regressions = 0
+    for result in current:
+        base = baseline.get(result["name"])
+        if base is None:
+            continue
+        change = result["ops_per_sec"] / base["ops_per_sec"] - 1.0
+        flag = ""
+        if change < -args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print("{:28s} {:10.2f} -> {:10.2f} ops/s {:+7.1%}{}".format(
+            result["name"], base["ops_per_sec"], result["ops_per_sec"],
+            change, flag))
+
+    if regressions:
+        raise SystemExit(str(regressions) + " benchmark(s) regressed more "
+                         "than " + format(args.threshold, ".0%"))
+
+
+parser = argparse.ArgumentParser(description="hipack benchmark suite")
+commands = parser.add_subparsers(dest="command")
+commands.required = True
+
+run_parser = commands.add_parser("run", help="Run benchmarks")
+run_parser.add_argument("--size", type=int, default=1000,
+        help="Approximate number of items in each document "
+             "[default: %(default)s]")
+run_parser.add_argument("--shape", dest="shapes", action="append",
+        choices=corpus.SHAPES,
+        help="Benchmark only documents of the given shape (can be given "
+             "multiple times) [default: all]")
+run_parser.add_argument("--min-time", type=float, default=1.0,
+        help="Minimum time to run each benchmark, in seconds "
+             "[default: %(default)s]")
+run_parser.add_argument("-o", "--output", default="-",
+        help="Output file for the results [default: stdout]")
+run_parser.set_defaults(func=run)
+
+compare_parser = commands.add_parser("compare",
+        help="Compare the results of two runs")
+compare_parser.add_argument("baseline", help="Results used as reference")
+compare_parser.add_argument("current", help="Results to check")
+compare_parser.add_argument("--threshold", type=float, default=0.1,
+        help="Maximum slowdown allowed, as a fraction [default: %(default)s]")
+compare_parser.set_defaults(func=compare)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if getattr(args, "shapes", ()) is None:
+        args.shapes = corpus.SHAPES
+    args.func(args)
@@ -13,7 +13,19 @@
 __version__ = 15
 __heps__ = (1,)
 
+import functools
+import hashlib
+import io
+import mmap
+import os
+import pickle
+import re
 import string
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from copy import deepcopy
+from itertools import islice
 from io import BytesIO, TextIOWrapper
 
 _SPACE = b" "
@@ -28,7 +40,6 @@ _LBRACKET = b"["
 _RBRACKET = b"]"
 _DQUOTE = b"\""
 _OCTOTHORPE = b"#"
-_SLASHDQUOTE = b"\\\""
 _BACKSLASH = b"\\"
 _NUMBER_SIGNS = b"+-"
 _ZERO = b"0"
@@ -70,6 +81,50 @@ ANNOT_LIST = ".list"
 ANNOT_DICT = ".dict"
 
 
+# Escape sequences used when dumping strings. Control characters which do not
+# have a short escape sequence are written using a hexadecimal one.
+_ESCAPES = {
+    u"\"": u"\\\"",
+    u"\\": u"\\\\",
+    u"\n": u"\\n",
+    u"\r": u"\\r",
+    u"\t": u"\\t",
+}
+for _code in list(range(0x20)) + [0x7F]:
+    _ESCAPES.setdefault(chr(_code), u"\\{:02X}".format(_code))
+del _code
+_BYTES_ESCAPES = dict((k.encode("ascii"), v.encode("ascii"))
+                      for (k, v) in _ESCAPES.items())
+_ESCAPE_RE = re.compile(u"[\x00-\x1F\x7F\"\\\\]")
+_BYTES_ESCAPE_RE = re.compile(b"[\x00-\x1F\x7F\"\\\\]")
+# Control characters without a short escape sequence are rare, so they are
+# handled separately from the common ones, which use plain replacements.
+_BYTES_HEX_ESCAPE_RE = re.compile(b"[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]")
+
+
+def _escape_str(s):
+    if _ESCAPE_RE.search(s) is None:
+        return s.encode("utf-8")
+    return _escape_encoded(s.encode("utf-8"))
+
+
+def _escape_bytes(s):
+    if _BYTES_ESCAPE_RE.search(s) is None:
+        return s
+    return _escape_encoded(s)
+
+
+def _escape_encoded(s):
+    # The backslash must be escaped first, as the other escape sequences
+    # introduce backslashes of their own.
+    s = (s.replace(b"\\", b"\\\\").replace(b"\"", b"\\\"")
+         .replace(b"\n", b"\\n").replace(b"\r", b"\\r")
+         .replace(b"\t", b"\\t"))
+    if _BYTES_HEX_ESCAPE_RE.search(s) is not None:
+        s = _BYTES_HEX_ESCAPE_RE.sub(lambda m: _BYTES_ESCAPES[m.group()], s)
+    return s
+
+
 def _is_hipack_key_character(ch):
     return ch not in _NON_KEY_CHARS
 
@@ -78,47 +133,244 @@ def _is_hipack_whitespace(ch):
     return ch in _WHITESPACE
 
 
-def _dump_value(obj, stream, indent, value):
-    if isinstance(obj, float):
-        stream.write(str(obj).encode("ascii"))
-    elif isinstance(obj, bool):
-        stream.write(_TRUE if obj else _FALSE)
-    elif isinstance(obj, int):
-        stream.write(str(obj).encode("ascii"))
-    elif isinstance(obj, str):
-        stream.write(_DQUOTE)
-        stream.write(obj.encode("utf-8").replace(_DQUOTE, _SLASHDQUOTE))
-        stream.write(_DQUOTE)
-    elif isinstance(obj, str) or isinstance(obj, bytes):
-        stream.write(_DQUOTE)
-        stream.write(obj.replace(_DQUOTE, _SLASHDQUOTE))
-        stream.write(_DQUOTE)
-    elif isinstance(obj, (tuple, list, set, frozenset)):
-        stream.write(_LBRACKET)
-        for item in obj:
-            if indent >= 0:
-                stream.write(_NEWLINE)
-                stream.write(_SPACE * ((indent + 1) * 2))
-                _dump_value(item, stream, indent + 1, value)
+class FrozenDict(Mapping):
+    """
+    Immutable mapping, used to represent dictionaries in immutable trees of
+    values. Instances are hashable as long as their values are hashable, and
+    the hash value is calculated only once.
+
+    :param items:
+        Initial contents, accepting the same arguments as `dict`.
+    """
+
+    __slots__ = ("_data", "_hash")
+
+    def __init__(self, *args, **kwargs):
+        self._data = dict(*args, **kwargs)
+        self._hash = None
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self._data.items()))
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, FrozenDict):
+            other = other._data
+        return self._data == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "FrozenDict(" + repr(self._data) + ")"
+
+    def __reduce__(self):
+        return (FrozenDict, (self._data,))
+
+
+_MAPPING_TYPES = (dict, FrozenDict)
+
+
+class Raw(object):
+    """
+    Wraps a pre-serialized HiPack value, which is written verbatim by the
+    dumper instead of converting a Python object.
+
+    :param data:
+        Representation of a single HiPack value, as `bytes`. Passing a `str`
+        is valid as well, which is encoded as UTF-8.
+    :param bool validate:
+        Whether to check that `data` contains exactly one valid value, raising
+        :class:`ParseError` otherwise. (Default: `False`).
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data, validate=False):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        elif not isinstance(data, bytes):
+            raise TypeError("Raw data is not bytes: " + repr(data))
+        if validate:
+            parser = Parser(BytesIO(data))
+            parser.parse_value()
+            parser.skip_whitespace()
+            if parser.look != _EOF:
+                parser.error("Unexpected input after raw value")
+        self.data = data
+
+    def __repr__(self):
+        return "Raw(" + repr(self.data) + ")"
+
+
+# Kinds of containers in the stack of the dumper.
+_FRAME_LIST = 0
+_FRAME_DICT = 1
+_FRAME_END = object()
+
+
+def _dump_annotations(annotations, stream, canonical=False):
+    if canonical:
+        annotations = sorted(annotations)
+    seen = set()
+    for annot in iter(annotations):
+        annot = _check_key(annot, "Annotation")
+        if annot in seen:
+            raise ValueError("Duplicated annotation: " + repr(annot))
+        seen.add(annot)
+        stream.write(_COLON)
+        stream.write(annot)
+
+
+def _canonical_float(v):
+    if v != v or v in (float("inf"), float("-inf")):
+        raise ValueError("Value cannot be represented: " + repr(v))
+    return repr(v).encode("ascii")
+
+
+def _canonical_value(obj, value):
+    output = BytesIO()
+    _dump_tree(obj, output, -1, value, canonical=True)
+    return output.getvalue()
+
+
+def _dump_tree(obj, stream, indent, value, encoder=None, max_depth=None,
+               body=False, canonical=False):
+    # Containers are not dumped recursively: instead, a stack is used to
+    # keep track of the containers being written. Each frame holds the kind
+    # of container, an iterator over its items (or keys), the container
+    # itself, the indentation level of the container and of its items, the
+    # data to write after the container has been closed, and its identifier,
+    # which is used to detect circular references.
+    write = stream.write
+    stack = []
+    active = set()
+
+    if body:
+        # Items of the top-level dictionary, written without braces.
+        v = _FRAME_END
+        active.add(id(obj))
+        stack.append((_FRAME_DICT, iter(sorted(obj.keys())), obj, indent,
+                      indent, None, id(obj)))
+    else:
+        v, level, suffix = obj, indent, b""
+
+    while True:
+        if v is _FRAME_END:
+            if not stack:
+                break
+            kind, items, container, level, inner, suffix, oid = stack[-1]
+            item = next(items, _FRAME_END)
+            if item is _FRAME_END:
+                # All items written, close the container.
+                stack.pop()
+                active.discard(oid)
+                if suffix is None:
+                    continue  # Top-level dictionary, no braces.
+                if kind is _FRAME_LIST:
+                    if level >= 0:
+                        write(_NEWLINE)
+                        write(_SPACE * (level * 2))
+                    write(_RBRACKET)
+                else:
+                    write(_SPACE * (level * 2))
+                    write(_RBRACE)
+                write(suffix)
+                continue
+
+            if kind is _FRAME_LIST:
+                if level >= 0:
+                    write(_NEWLINE)
+                    write(_SPACE * (inner * 2))
+                    suffix = b""
+                else:
+                    suffix = _COMMA
+                v, level = item, inner
             else:
-                _dump_value(item, stream, indent, value)
-                stream.write(_COMMA)
-        if indent >= 0:
-            stream.write(_NEWLINE)
-            stream.write(_SPACE * (indent * 2))
-        stream.write(_RBRACKET)
-    elif isinstance(obj, dict):
-        stream.write(_LBRACE)
-        if indent >= 0:
-            stream.write(_NEWLINE)
-            _dump_dict(obj, stream, indent + 1, value)
-            stream.write(_SPACE * (indent * 2))
+                # Dictionaries are always dumped with their keys sorted,
+                # in order to produce a predictable output.
+                v, annotations = value(container[item])
+                item = _check_key(item)
+                write(_SPACE * (inner * 2))
+                write(item)
+                write(_COLON)
+                if annotations is not None and len(annotations) > 0:
+                    _dump_annotations(annotations, stream, canonical)
+                    write(_SPACE)
+                elif inner >= 0:
+                    write(_SPACE)
+                level = inner
+                suffix = _NEWLINE if inner >= 0 else _SPACE
+
+        if isinstance(v, float):
+            write(_canonical_float(v) if canonical else str(v).encode("ascii"))
+        elif isinstance(v, bool):
+            write(_TRUE if v else _FALSE)
+        elif isinstance(v, int):
+            write(str(v).encode("ascii"))
+        elif isinstance(v, str):
+            write(_DQUOTE)
+            write(_escape_str(v))
+            write(_DQUOTE)
+        elif isinstance(v, bytes):
+            write(_DQUOTE)
+            write(_escape_bytes(v))
+            write(_DQUOTE)
+        elif encoder is not None and isinstance(v, encoder.CACHEABLE_TYPES):
+            write(encoder.encode_value(v, level))
+        elif canonical and isinstance(v, (set, frozenset)):
+            # Sets have no defined order: sort the items by their encoded
+            # representation. Sets cannot contain mutable containers, so
+            # there is no need to check for circular references.
+            write(_LBRACKET)
+            for data in sorted(_canonical_value(item, value) for item in v):
+                write(data)
+                write(_COMMA)
+            write(_RBRACKET)
+        elif isinstance(v, (tuple, list, set, frozenset, dict, FrozenDict)):
+            if max_depth is not None and len(stack) >= max_depth:
+                raise ValueError("Maximum nesting depth exceeded: " +
+                                 str(max_depth))
+            oid = id(v)
+            if oid in active:
+                raise ValueError("Circular reference detected")
+            active.add(oid)
+            if isinstance(v, _MAPPING_TYPES):
+                write(_LBRACE)
+                if level >= 0:
+                    write(_NEWLINE)
+                stack.append((_FRAME_DICT, iter(sorted(v.keys())), v, level,
+                              level + 1 if level >= 0 else level, suffix, oid))
+            else:
+                write(_LBRACKET)
+                stack.append((_FRAME_LIST, iter(v), v, level,
+                              level + 1 if level >= 0 else level, suffix, oid))
+            v = _FRAME_END
+            continue
+        elif isinstance(v, Raw):
+            write(v.data)
         else:
-            _dump_dict(obj, stream, indent, value)
-        stream.write(_RBRACE)
-    else:
-        raise TypeError("Values of type " + str(type(obj)) +
-                        " cannot be dumped")
+            raise TypeError("Values of type " + str(type(v)) +
+                            " cannot be dumped")
+        write(suffix)
+        v = _FRAME_END
+
+
+def _dump_value(obj, stream, indent, value, encoder=None, max_depth=None):
+    _dump_tree(obj, stream, indent, value, encoder, max_depth)
 
 
 def _check_key(k, thing="Key"):
@@ -139,29 +391,8 @@ def _check_key(k, thing="Key"):
     return k
 
 
-def _dump_dict(obj, stream, indent, value):
-    # Dictionaries are always dumped with their keys sorted,
-    # in order to produce a predictable output.
-    for k in sorted(obj.keys()):
-        v, annotations = value(obj[k])
-        k = _check_key(k)
-        stream.write(_SPACE * (indent * 2))
-        stream.write(k)
-        stream.write(_COLON)
-        if annotations is not None and len(annotations) > 0:
-            seen = set()
-            for annot in iter(annotations):
-                annot = _check_key(annot, "Annotation")
-                if annot in seen:
-                    raise ValueError("Duplicated annotation: " + repr(annot))
-                seen.add(annot)
-                stream.write(_COLON)
-                stream.write(annot)
-            stream.write(_SPACE)
-        elif indent >= 0:
-            stream.write(_SPACE)
-        _dump_value(v, stream, indent, value)
-        stream.write(_NEWLINE if indent >= 0 else _SPACE)
+def _dump_dict(obj, stream, indent, value, encoder=None, max_depth=None):
+    _dump_tree(obj, stream, indent, value, encoder, max_depth, True)
 
 
 def value(obj):
@@ -171,7 +402,64 @@ def value(obj):
     return obj, None
 
 
-def dump(obj, stream, indent=True, value=value):
+class DumpStats(object):
+    """
+    Counters updated while writing HiPack messages, which can be passed to
+    :func:`dump()` and :func:`dumps()`. The same object can be reused to
+    accumulate the counters of multiple messages.
+
+    :attribute writes:
+        Number of calls to the `.write()` method of the output stream.
+    :attribute bytes_written:
+        Number of bytes written to the output stream.
+    :attribute value_calls:
+        Number of calls to the `value` function.
+    :attribute value_time:
+        Total time spent in the `value` function, in seconds.
+    """
+
+    __slots__ = ("writes", "bytes_written", "value_calls", "value_time")
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes_written = 0
+        self.value_calls = 0
+        self.value_time = 0.0
+
+    def as_dict(self):
+        """
+        Returns the counters as a dictionary.
+        """
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def _wrap_stream(self, stream):
+        write = stream.write
+        def counting_write(data):
+            self.writes += 1
+            self.bytes_written += len(data)
+            return write(data)
+        return _Writer(counting_write)
+
+    def _wrap_value(self, value):
+        def timed_value(obj):
+            start = time.perf_counter()
+            try:
+                return value(obj)
+            finally:
+                self.value_calls += 1
+                self.value_time += time.perf_counter() - start
+        return timed_value
+
+
+class _Writer(object):
+    __slots__ = ("write",)
+
+    def __init__(self, write):
+        self.write = write
+
+
+def dump(obj, stream, indent=True, value=value, max_depth=None, framed=False,
+         stats=None):
     """
     Writes Python objects to a writable stream as a HiPack message.
 
@@ -188,10 +476,28 @@ def dump(obj, stream, indent=True, value=value):
         than those supported by HiPack. The function is passed a Python
         object, and it must return an object that can be represented as a
         HiPack value.
+    :param int max_depth:
+        Maximum nesting depth of containers, including the message itself.
+        When the limit is exceeded, `ValueError` is raised. By default, the
+        nesting depth is not limited. Circular references are always detected
+        and also raise `ValueError`.
+    :param bool framed:
+        Whether to enclose the message in braces, followed by a newline. This
+        allows writing multiple messages to the same stream, which can be
+        read back using :func:`Parser.messages()`. (Default: `False`).
+    :param DumpStats stats:
+        When given, the counters of this object are updated while writing.
     """
+    _dump(obj, stream, indent, value, None, max_depth, framed, stats)
+
+
+def _dump(obj, stream, indent, value, encoder, max_depth, framed=False,
+          stats=None):
     assert callable(value)
+    if stats is not None:
+        value = stats._wrap_value(value)
     obj, annotations = value(obj)
-    if not isinstance(obj, dict):
+    if not isinstance(obj, _MAPPING_TYPES):
         raise TypeError("Dictionary value expected")
 
     flush_after = False
@@ -200,13 +506,23 @@ def dump(obj, stream, indent=True, value=value):
         stream = stream.buffer
         flush_after = True
 
-    _dump_dict(obj, stream, 0 if indent else -1, value)
+    if stats is not None:
+        stream = stats._wrap_stream(stream)
+
+    if framed:
+        _dump_value(obj, stream, 0 if indent else -1, value, encoder,
+                    max_depth)
+        stream.write(_NEWLINE)
+    else:
+        _dump_dict(obj, stream, 0 if indent else -1, value, encoder,
+                   max_depth)
 
     if flush_after:
         stream.flush()
 
 
-def dumps(obj, indent=True, value=value):
+def dumps(obj, indent=True, value=value, max_depth=None, framed=False,
+          stats=None):
     """
     Serializes a Python object into a string in HiPack format.
 
@@ -217,12 +533,324 @@ def dumps(obj, indent=True, value=value):
         of writing the whole message in single line. (Default: `False`).
     :param callable value:
         A Python object conversion function, see :func:`dump()` for details.
+    :param int max_depth:
+        Maximum nesting depth of containers, see :func:`dump()` for details.
+    :param bool framed:
+        Whether to enclose the message in braces, see :func:`dump()` for
+        details.
+    :param DumpStats stats:
+        When given, the counters of this object are updated while writing.
+    """
+    output = BytesIO()
+    dump(obj, output, indent, value, max_depth, framed, stats)
+    return output.getvalue()
+
+
+class _BufferWriter(object):
+    __slots__ = ("buffer", "position", "grow")
+
+    def __init__(self, buf, offset, grow):
+        if isinstance(buf, bytearray):
+            self.grow = grow
+        else:
+            buf = memoryview(buf)
+            if buf.readonly:
+                raise TypeError("Buffer is not writable")
+            buf = buf.cast("B")
+            self.grow = False
+        if offset < 0 or offset > len(buf):
+            raise ValueError("Offset out of buffer bounds: " + repr(offset))
+        self.buffer = buf
+        self.position = offset
+
+    def write(self, data):
+        end = self.position + len(data)
+        if end > len(self.buffer) and not self.grow:
+            raise BufferError("Buffer too small, at least " + str(end) +
+                              " bytes are needed")
+        self.buffer[self.position:end] = data
+        self.position = end
+
+
+class _CountingWriter(object):
+    __slots__ = ("count",)
+
+    def __init__(self):
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+
+
+def canonical_dumps(obj, value=value):
+    """
+    Serializes a Python object into its canonical HiPack representation.
+
+    The canonical representation is always compact, and equal values always
+    produce the same output: dictionary keys and annotations are sorted, the
+    items of sets are sorted by their canonical representation, and floating
+    point numbers are written using their shortest exact representation.
+    Floating point values which cannot be represented (infinities and NaN)
+    raise `ValueError`. This makes the output suitable to be compared, or
+    used as a cache key.
+
+    :param obj:
+        Object to be serialized.
+    :param callable value:
+        A Python object conversion function, see :func:`dump()` for details.
+    """
+    output = BytesIO()
+    _dump_canonical(obj, output, value)
+    return output.getvalue()
+
+
+def _dump_canonical(obj, stream, value):
+    assert callable(value)
+    obj, annotations = value(obj)
+    if not isinstance(obj, _MAPPING_TYPES):
+        raise TypeError("Dictionary value expected")
+    _dump_tree(obj, stream, -1, value, body=True, canonical=True)
+
+
+def digest(obj, algo="sha256", value=value):
+    """
+    Calculates a hash of the canonical representation of a Python object (see
+    :func:`canonical_dumps()`) and returns it as a string of hexadecimal
+    digits. The representation is fed to the hash function as it is being
+    generated, without keeping it in memory.
+
+    :param obj:
+        Object to be hashed.
+    :param str algo:
+        Name of the hash algorithm, which must be supported by the
+        :mod:`hashlib` module. (Default: `"sha256"`).
+    :param callable value:
+        A Python object conversion function, see :func:`dump()` for details.
+    """
+    h = hashlib.new(algo)
+    _dump_canonical(obj, _Writer(h.update), value)
+    return h.hexdigest()
+
+
+def dumps_into(obj, buf, offset=0, indent=True, value=value, grow=True):
+    """
+    Serializes a Python object in HiPack format into a caller-provided buffer.
+
+    :param obj:
+        Object to be serialized and written.
+    :param buf:
+        A `bytearray`, or any other object supporting the writable buffer
+        protocol (e.g. a `memoryview`).
+    :param int offset:
+        Position in the buffer at which to start writing. (Default: `0`).
+    :param bool indent:
+        Whether to pretty-print and indent the written message, see
+        :func:`dump()` for details.
+    :param callable value:
+        A Python object conversion function, see :func:`dump()` for details.
+    :param bool grow:
+        Whether to enlarge the buffer when it is too small. Only objects of
+        type `bytearray` can be enlarged; for other buffers, or when `grow`
+        is `False`, :class:`BufferError` is raised when the serialized object
+        does not fit. (Default: `True`).
+    :return:
+        The number of bytes written.
+
+    When an error is raised, the contents of the buffer past `offset` are
+    unspecified.
+    """
+    writer = _BufferWriter(buf, offset, grow)
+    dump(obj, writer, indent, value)
+    return writer.position - offset
+
+
+def dumped_size(obj, indent=True, value=value):
+    """
+    Calculates the size in bytes of the HiPack representation of a Python
+    object, without keeping the serialized data in memory. This is useful
+    to pre-size buffers passed to :func:`dumps_into()`.
+
+    :param obj:
+        Object to be serialized.
+    :param bool indent:
+        Whether to pretty-print and indent the message, see :func:`dump()`
+        for details.
+    :param callable value:
+        A Python object conversion function, see :func:`dump()` for details.
     """
+    writer = _CountingWriter()
+    dump(obj, writer, indent, value)
+    return writer.count
+
+
+def _dumps_chunk(args):
+    objs, indent, value = args
     output = BytesIO()
-    dump(obj, output, indent, value)
+    for obj in objs:
+        dump(obj, output, indent, value, framed=True)
     return output.getvalue()
 
 
+def dumps_batch(objs, stream=None, workers=None, chunksize=64, indent=False,
+                value=value):
+    """
+    Serializes many Python objects as a sequence of framed messages, using a
+    pool of worker processes. Messages are written in the same order as the
+    input objects, and can be read back using :func:`Parser.messages()`.
+
+    :param objs:
+        Iterable of objects to be serialized.
+    :param stream:
+        A file-like object with a `.write(b)` method. If `None` is passed,
+        the serialized messages are returned as a single string.
+    :param int workers:
+        Number of worker processes. When `None`, the number of processors in
+        the system is used. If the value is `1` (or there is only one
+        processor), the messages are serialized in the calling process.
+    :param int chunksize:
+        Number of objects serialized by a worker in a single task.
+        (Default: `64`).
+    :param bool indent:
+        Whether to pretty-print and indent the written messages.
+        (Default: `False`).
+    :param callable value:
+        A Python object conversion function, see :func:`dump()` for details.
+        The function is passed to the worker processes, and therefore it must
+        be possible to pickle it, otherwise `TypeError` is raised.
+    """
+    assert callable(value)
+    assert chunksize > 0
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    output = BytesIO() if stream is None else stream
+
+    if workers <= 1:
+        for obj in objs:
+            dump(obj, output, indent, value, framed=True)
+    else:
+        try:
+            pickle.dumps(value)
+        except Exception as e:
+            raise TypeError("Value function " + repr(value) +
+                            " cannot be pickled: " + str(e))
+
+        def chunks():
+            items = iter(objs)
+            while True:
+                chunk = list(islice(items, chunksize))
+                if not chunk:
+                    break
+                yield (chunk, indent, value)
+
+        from multiprocessing import Pool
+        with Pool(workers) as pool:
+            for data in pool.imap(_dumps_chunk, chunks()):
+                output.write(data)
+
+    if stream is None:
+        return output.getvalue()
+
+
+_IMMUTABLE_SCALAR_TYPES = (str, bytes, int, float)
+
+
+def _is_immutable(obj):
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, (tuple, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, FrozenDict):
+            stack.extend(obj.values())
+        elif not isinstance(obj, _IMMUTABLE_SCALAR_TYPES):
+            return False
+    return True
+
+
+class Encoder(object):
+    """
+    Serializes Python objects as HiPack messages, keeping a cache of the
+    encoded representation of immutable sub-trees.
+
+    Values of type `tuple`, `frozenset` and :class:`FrozenDict` are cached
+    when all their contents are immutable as well, that is, strings,
+    numbers, and other values of those types. Once encoded, their
+    representation is reused every time the *same object* is found again
+    while dumping, for both indented and compact output. Sub-trees which
+    contain mutable values (e.g. a tuple of dictionaries) are encoded again
+    each time. The encoder keeps references to the cached objects, which
+    guarantees that they are not reused for other objects. Note that the
+    `value` function is not called again for the contents of a cached
+    sub-tree, so it must always produce the same result for the same input.
+
+    :param callable value:
+        A Python object conversion function, see :func:`dump()` for details.
+    :param int cache_size:
+        Maximum number of encoded sub-trees to keep in the cache. The least
+        recently used entries are evicted first. (Default: `128`).
+    :param int max_depth:
+        Maximum nesting depth of containers, see :func:`dump()` for details.
+        Note that the limit is checked separately for the contents of each
+        cached sub-tree, as their encoding does not depend on the position
+        where they are found.
+    """
+
+    CACHEABLE_TYPES = (tuple, frozenset, FrozenDict)
+
+    def __init__(self, value=value, cache_size=128, max_depth=None):
+        assert callable(value)
+        self.value = value
+        self.cache_size = cache_size
+        self.max_depth = max_depth
+        self._cache = OrderedDict()
+
+    def encode_value(self, obj, indent):
+        """
+        Returns the encoded representation of a value, using the cache when
+        possible. The `indent` argument is the indentation level at which the
+        value is written, or `-1` for compact output.
+        """
+        key = (id(obj), indent)
+        entry = self._cache.get(key)
+        if entry is not None:
+            self._cache.move_to_end(key)
+            return entry[1]
+
+        output = BytesIO()
+        _dump_value(obj, output, indent, self.value, None, self.max_depth)
+        data = output.getvalue()
+        if self.cache_size > 0 and _is_immutable(obj):
+            # The object is stored along the data to keep it alive, which
+            # ensures that its identifier is not reused for other objects.
+            self._cache[key] = (obj, data)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return data
+
+    def clear(self):
+        """
+        Removes all the entries from the cache.
+        """
+        self._cache.clear()
+
+    def dump(self, obj, stream, indent=True):
+        """
+        Writes Python objects to a writable stream as a HiPack message. See
+        :func:`dump()` for details.
+        """
+        _dump(obj, stream, indent, self.value, self, self.max_depth)
+
+    def dumps(self, obj, indent=True):
+        """
+        Serializes a Python object into a string in HiPack format. See
+        :func:`dumps()` for details.
+        """
+        output = BytesIO()
+        self.dump(obj, output, indent)
+        return output.getvalue()
+
+
 class ParseError(ValueError):
     """
     Use to signal an error when parsing a HiPack message.
@@ -243,6 +871,144 @@ class ParseError(ValueError):
         self.message = message
 
 
+class LimitError(ParseError):
+    """
+    Use to signal that parsing a HiPack message has exceeded one of the
+    configured :class:`Limits`.
+
+    :attribute limit:
+        Name of the limit which was exceeded (e.g. ``"max_depth"``).
+    """
+
+    def __init__(self, line, column, message, limit):
+        super(LimitError, self).__init__(line, column, message)
+        self.limit = limit
+
+
+class Limits(object):
+    """
+    Limits on the resources used when parsing a HiPack message. Parsing stops
+    by raising :class:`LimitError` as soon as one of the limits is exceeded.
+    A limit set to `None` is not checked.
+
+    :param int max_bytes:
+        Maximum number of bytes read from the input stream.
+    :param int max_depth:
+        Maximum nesting depth of lists and dictionaries, including the
+        message itself.
+    :param int max_keys:
+        Maximum number of items in each dictionary, including the message
+        itself.
+    :param int max_string:
+        Maximum length of strings and keys, in bytes.
+    """
+
+    __slots__ = ("max_bytes", "max_depth", "max_keys", "max_string")
+
+    def __init__(self, max_bytes=None, max_depth=None, max_keys=None,
+                 max_string=None):
+        self.max_bytes = max_bytes
+        self.max_depth = max_depth
+        self.max_keys = max_keys
+        self.max_string = max_string
+
+
+_INTRINSIC_ANNOTATIONS = (ANNOT_INT, ANNOT_FLOAT, ANNOT_BOOL, ANNOT_STRING,
+                          ANNOT_LIST, ANNOT_DICT)
+
+
+class ParseStats(object):
+    """
+    Counters updated while parsing HiPack messages, which can be passed to
+    :class:`Parser`, :func:`load()` and :func:`loads()`. The same object can
+    be reused to accumulate the counters of multiple messages.
+
+    :attribute reads:
+        Number of calls to the `.read()` method of the input stream.
+    :attribute bytes_read:
+        Number of bytes read from the input stream.
+    :attribute values:
+        Dictionary which maps intrinsic type annotations (:data:`ANNOT_INT`,
+        :data:`ANNOT_STRING`, etc.) to the number of parsed values of each
+        type.
+    :attribute casts:
+        Number of calls to the `cast` function.
+    :attribute cast_time:
+        Total time spent in the `cast` function, in seconds.
+    """
+
+    __slots__ = ("reads", "bytes_read", "values", "casts", "cast_time")
+
+    def __init__(self):
+        self.reads = 0
+        self.bytes_read = 0
+        self.values = dict((annot, 0) for annot in _INTRINSIC_ANNOTATIONS)
+        self.casts = 0
+        self.cast_time = 0.0
+
+    def as_dict(self):
+        """
+        Returns the counters as a dictionary.
+        """
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def _wrap_stream(self, stream):
+        return _StatsReader(stream, self)
+
+    def _wrap_cast(self, cast):
+        values = self.values
+        def timed_cast(annotations, bytestring, value):
+            for annot in _INTRINSIC_ANNOTATIONS:
+                if annot in annotations:
+                    values[annot] += 1
+                    break
+            start = time.perf_counter()
+            try:
+                return cast(annotations, bytestring, value)
+            finally:
+                self.casts += 1
+                self.cast_time += time.perf_counter() - start
+        return timed_cast
+
+
+class _StatsReader(object):
+    __slots__ = ("stream", "stats")
+
+    def __init__(self, stream, stats):
+        self.stream = stream
+        self.stats = stats
+
+    def read(self, n=-1):
+        data = self.stream.read(n)
+        self.stats.reads += 1
+        self.stats.bytes_read += len(data)
+        return data
+
+    def tell(self):
+        return self.stream.tell()
+
+
+class _LimitedReader(object):
+    __slots__ = ("stream", "parser", "remaining")
+
+    def __init__(self, stream, parser, max_bytes):
+        self.stream = stream
+        self.parser = parser
+        self.remaining = max_bytes
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.remaining + 1
+        data = self.stream.read(min(n, self.remaining + 1))
+        self.remaining -= len(data)
+        if self.remaining < 0:
+            self.parser.limit_error("max_bytes", "Input too large")
+        return data
+
+    def tell(self):
+        return self.stream.tell()
+
+
 def cast(annotations, bytestring, value):
     """
     Default “cast” function.
@@ -250,6 +1016,9 @@ def cast(annotations, bytestring, value):
     return value
 
 
+_default_cast = cast
+
+
 class Parser(object):
     """
     Parses HiPack messages and converts them to Python objects.
@@ -264,14 +1033,53 @@ class Parser(object):
         `bytes` representation before converting a simple literal value (that
         is, all except lists and dictionaries, for which `None` is passed
         instead), and the converted value.
+
+    :param Limits limits:
+        Limits on the resources used while parsing. When `None`, no limits
+        are enforced. This should be used when parsing untrusted input.
+
+    :param ParseStats stats:
+        When given, the counters of this object are updated while parsing.
+
+    :param dedupe:
+        When `True`, repeated strings and keys share the same object. When
+        ``"subtrees"``, the results are frozen (see below), and structurally
+        identical lists and dictionaries share the same object.
+        (Default: `False`).
+
+    :param bool frozen:
+        When `True`, lists are returned as tuples and dictionaries as
+        :class:`FrozenDict` objects, including the messages themselves.
+        The results are read-only and hashable, so they can be shared among
+        threads without locking, and used as keys in dictionaries. Note that
+        the `cast` function receives those immutable types as well.
+        (Default: `False`).
     """
 
-    def __init__(self, stream, cast=cast):
+    def __init__(self, stream, cast=cast, limits=None, stats=None,
+                 dedupe=False, frozen=False):
         assert callable(cast)
         self.cast = cast
         self.look = None
         self.line = 1
         self.column = 0
+        self.depth = 1
+        self.dedupe = dedupe
+        self.strings = {} if dedupe else None
+        self.subtrees = {} if dedupe == "subtrees" else None
+        self.subtree_ids = set()
+        self.frozen = frozen or self.subtrees is not None
+        if limits is None:
+            limits = Limits()
+        self.limits = limits
+        self.max_depth = limits.max_depth
+        self.max_keys = limits.max_keys
+        self.max_string = limits.max_string
+        if stats is not None:
+            stream = stats._wrap_stream(stream)
+            self.cast = stats._wrap_cast(cast)
+        if limits.max_bytes is not None:
+            stream = _LimitedReader(stream, self, limits.max_bytes)
         self.stream = stream
         self.nextchar()
         self.skip_whitespace()
@@ -280,6 +1088,9 @@ class Parser(object):
     def error(self, message):
         raise ParseError(self.line, self.column, message)
 
+    def limit_error(self, limit, message):
+        raise LimitError(self.line, self.column, message, limit)
+
     def _basic_match(self, char, expected_message):
         if self.look != char:
             if expected_message is None:  # pragma: no cover
@@ -319,12 +1130,17 @@ class Parser(object):
 
     def parse_key(self):
         key = BytesIO()
+        max_string = self.max_string
         while self.look != _EOF and _is_hipack_key_character(self.look):
             key.write(self.look)
+            if max_string is not None and key.tell() > max_string:
+                self.limit_error("max_string", "Key too long")
             self.nextchar()
         key = key.getvalue().decode("utf-8")
         if len(key) == 0:
             self.error("key expected")
+        if self.strings is not None:
+            key = self.strings.setdefault(key, key)
         return key
 
     def parse_bool(self, annotations):
@@ -344,9 +1160,16 @@ class Parser(object):
 
     def parse_string(self, annotations):
         value = BytesIO()
-        self.match(_DQUOTE)
+        # The first character is read with getchar() instead of nextchar(),
+        # otherwise a leading "#" inside the string is taken as a comment.
+        if self.look == _DQUOTE:
+            self.look = self.getchar()
+        else:
+            self.match(_DQUOTE)
         value.write(_DQUOTE)
 
+        # The opening double quote is included in the length.
+        max_length = None if self.max_string is None else self.max_string + 1
         while self.look != _EOF and self.look != _DQUOTE:
             if self.look == _BACKSLASH:
                 self.look = self.getchar()
@@ -366,13 +1189,18 @@ class Parser(object):
                     self.look = (chr(16 * int(self.look, 16) + int(extra, 16))).encode("ascii")
 
             value.write(self.look)
+            if max_length is not None and value.tell() > max_length:
+                self.limit_error("max_string", "String too long")
             self.look = self.getchar()
         self.match(_DQUOTE)
         value.write(_DQUOTE)
 
         annotations.add(ANNOT_STRING)
         value = value.getvalue()
-        return self.cast(frozenset(annotations), value, value[1:-1].decode("utf-8"))
+        result = value[1:-1].decode("utf-8")
+        if self.strings is not None:
+            result = self.strings.setdefault(result, result)
+        return self.cast(frozenset(annotations), value, result)
 
     def parse_number(self, annotations):
         number = BytesIO()
@@ -451,15 +1279,25 @@ class Parser(object):
 
         return self.cast(frozenset(annotations), number, value)
 
+    def enter_container(self):
+        self.depth += 1
+        if self.max_depth is not None and self.depth > self.max_depth:
+            self.limit_error("max_depth", "Nesting too deep")
+
     def parse_dict(self, annotations):
+        self.enter_container()
         self.match(_LBRACE)
         self.skip_whitespace()
         result = self.parse_keyval_items(_RBRACE)
         self.match(_RBRACE)
+        self.depth -= 1
         annotations.add(ANNOT_DICT)
-        return self.cast(frozenset(annotations), None, result)
+        if self.frozen:
+            result = FrozenDict(result)
+        return self.share(self.cast(frozenset(annotations), None, result))
 
     def parse_list(self, annotations):
+        self.enter_container()
         self.match(_LBRACKET)
         self.skip_whitespace()
 
@@ -476,8 +1314,55 @@ class Parser(object):
             self.skip_whitespace()
 
         self.match(_RBRACKET)
+        self.depth -= 1
         annotations.add(ANNOT_LIST)
-        return self.cast(frozenset(annotations), None, result)
+        if self.frozen:
+            result = tuple(result)
+        return self.share(self.cast(frozenset(annotations), None, result))
+
+    def _share_key(self, item):
+        kind = type(item)
+        if kind is tuple or kind is FrozenDict:
+            # Only containers which are shared themselves can be part of
+            # other shared containers; those are identified by their "id".
+            return id(item) if id(item) in self.subtree_ids else None
+        if kind is float:
+            return (kind, item.hex())  # Tell apart 0.0 and -0.0.
+        if kind in (str, int, bool, bytes):
+            return (kind, item)
+        return None
+
+    def share(self, value):
+        """
+        Returns a previously parsed object which is structurally identical
+        to `value`, or `value` itself if there was none. Only tuples and
+        :class:`FrozenDict` objects which contain basic values (or other
+        shared containers) are considered.
+        """
+        if self.subtrees is None:
+            return value
+        kind = type(value)
+        if kind is tuple:
+            key = [kind]
+            for item in value:
+                item_key = self._share_key(item)
+                if item_key is None:
+                    return value
+                key.append(item_key)
+        elif kind is FrozenDict:
+            key = [kind]
+            for k in sorted(value):
+                item_key = self._share_key(value[k])
+                if item_key is None:
+                    return value
+                key.append((k, item_key))
+        else:
+            return value
+
+        shared = self.subtrees.setdefault(tuple(key), value)
+        if shared is value:
+            self.subtree_ids.add(id(value))
+        return shared
 
     def parse_annotations(self):
         annotations = set()
@@ -508,6 +1393,7 @@ class Parser(object):
 
     def parse_keyval_items(self, eos):
         result = {}
+        max_keys = self.max_keys
         while self.look != eos and self.look != _EOF:
             key = self.parse_key()
 
@@ -526,6 +1412,8 @@ class Parser(object):
                 self.error("missing separator")
 
             result[key] = self.parse_value()
+            if max_keys is not None and len(result) > max_keys:
+                self.limit_error("max_keys", "Too many dictionary items")
 
             # There must be either a comma or a whitespace character after the
             # value, or the end-of-sequence character.
@@ -547,16 +1435,27 @@ class Parser(object):
         if self.framed:
             if self.look != _EOF:
                 self.match(_LBRACE)
-                self.nextchar()
                 self.skip_whitespace()
                 result = self.parse_keyval_items(_RBRACE)
                 self.match(_RBRACE)
                 self.skip_whitespace()
         else:
             result = self.parse_keyval_items(_EOF)
+        if result is not None and self.frozen:
+            result = FrozenDict(result)
         return result
 
-    def messages(self):
+    def _frame_parser(self, stream):
+        # Used to parse each message separately when recovering from errors.
+        # Deduplicated strings and sub-trees are shared among all messages.
+        parser = Parser(stream, self.cast, self.limits, None, self.dedupe,
+                        self.frozen)
+        parser.strings = self.strings
+        parser.subtrees = self.subtrees
+        parser.subtree_ids = self.subtree_ids
+        return parser
+
+    def messages(self, recover=False, on_error=None, blocksize=65536):
         """
         Parses and yields each message contained in the input stream.
 
@@ -564,7 +1463,49 @@ class Parser(object):
         method yields exactly once. For an input with multiple, framed
         messages, each message is yield in the same order as they are in
         the input stream.
+
+        :param bool recover:
+            Whether to skip invalid framed messages instead of raising
+            :class:`ParseError`, optionally reporting them to `on_error`.
+            In this mode, the input is split into
+            messages by matching braces (ignoring those inside strings and
+            comments) before parsing, and parsing resumes at the start of the
+            next message after an invalid one. Note that a message with
+            unbalanced braces extends until the braces are balanced again,
+            possibly including other messages. For unframed input, a single
+            message is parsed, and errors are raised normally.
+            (Default: `False`).
+        :param callable on_error:
+            When recovering from errors, a function called for each invalid
+            message with the :class:`ParseError` and the start and end
+            offsets of the skipped input. Offsets are absolute if the
+            stream supports `.tell()`, otherwise they are relative to the
+            position where reading messages started. The line and column of
+            the error are those in the whole input.
+        :param int blocksize:
+            When recovering from errors, the size of the blocks in which the
+            input stream is read. (Default: `65536`).
         """
+        if recover and self.framed:
+            try:
+                offset = self.stream.tell() - len(self.look)
+            except (AttributeError, OSError, ValueError):
+                offset = 0
+            scanner = _FrameScanner(offset, self.line, self.column)
+            scanner.feed(self.look)
+            self.look = _EOF
+            if on_error is None:
+                on_error = _ignore_error
+            for _, _, message in _scan_messages(scanner, self.stream,
+                                                self._frame_parser,
+                                                on_error, blocksize):
+                yield message
+            return
+
+        if not self.framed:
+            yield self.parse_message()
+            return
+
         while True:
             message = self.parse_message()
             if message is None:
@@ -572,7 +1513,8 @@ class Parser(object):
             yield message
 
 
-def load(stream, cast=cast):
+def load(stream, cast=cast, limits=None, stats=None, dedupe=False,
+         frozen=False):
     """
     Parses a single message from an input stream.
 
@@ -580,11 +1522,24 @@ def load(stream, cast=cast):
         A file-like object with a `.read(n)` method.
     :param callable cast:
         A value conversion function, see :class:`Parser` for details.
+    :param Limits limits:
+        Limits on the resources used while parsing, see :class:`Parser` for
+        details.
+    :param ParseStats stats:
+        When given, the counters of this object are updated while parsing.
+    :param dedupe:
+        Whether to share repeated strings and sub-trees, see :class:`Parser`
+        for details.
+    :param bool frozen:
+        Whether to return immutable containers, see :class:`Parser` for
+        details.
     """
-    return Parser(stream, cast).parse_message()
+    return Parser(stream, cast, limits, stats, dedupe,
+                  frozen).parse_message()
 
 
-def loads(bytestring, cast=cast):
+def loads(bytestring, cast=cast, limits=None, stats=None, dedupe=False,
+          frozen=False):
     """
     Parses a single message contained in a string.
 
@@ -593,10 +1548,1914 @@ def loads(bytestring, cast=cast):
         objects as input.
     :param callable cast:
         A value conversion function, see :class:`Parser` for details.
+    :param Limits limits:
+        Limits on the resources used while parsing, see :class:`Parser` for
+        details.
+    :param ParseStats stats:
+        When given, the counters of this object are updated while parsing.
+    :param dedupe:
+        Whether to share repeated strings and sub-trees, see :class:`Parser`
+        for details.
+    :param bool frozen:
+        Whether to return immutable containers, see :class:`Parser` for
+        details.
     """
     if isinstance(bytestring, str):
         bytestring = bytestring.encode("utf-8")
-    return load(BytesIO(bytestring), cast)
+    if limits is not None and limits.max_bytes is not None and \
+            len(bytestring) > limits.max_bytes:
+        raise LimitError(1, 0, "Input too large", "max_bytes")
+    return load(BytesIO(bytestring), cast, limits, stats, dedupe, frozen)
+
+
+# Compression formats supported by open(), with the magic bytes at the
+# start of the files and their usual extensions.
+_COMPRESSION_MAGIC = (
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "lzma"),
+)
+_COMPRESSION_EXTENSIONS = {
+    ".gz": "gzip",
+    ".bz2": "bz2",
+    ".xz": "lzma",
+    ".lzma": "lzma",
+}
+
+
+def _compression_module(name):
+    if name == "gzip":
+        import gzip
+        return gzip
+    elif name == "bz2":
+        import bz2
+        return bz2
+    elif name == "lzma":
+        import lzma
+        return lzma
+    raise ValueError("Unsupported compression: " + repr(name))
+
+
+def open(file, mode="rb", compression="auto", blocksize=1 << 20):
+    """
+    Opens a file for reading or writing HiPack messages, compressing and
+    decompressing the data transparently. The returned object is buffered
+    using large blocks, which makes reading one character at a time (as
+    done by :class:`Parser`) fast even for compressed files.
+
+    :param file:
+        Path to a file, or a binary file-like object. File objects are
+        returned as they are when no compression is used, and otherwise
+        they are not closed along with the returned object.
+    :param str mode:
+        One of ``"rb"``, ``"wb"``, ``"ab"`` or ``"xb"``; the ``"b"`` may be
+        omitted, as files are always opened in binary mode.
+    :param str compression:
+        One of ``"gzip"``, ``"bz2"``, ``"lzma"``, or `None` for uncompressed
+        data. With ``"auto"``, files being read are detected by their first
+        bytes, and files being written by the extension of their path (one
+        of ``.gz``, ``.bz2``, ``.xz`` or ``.lzma``). (Default: ``"auto"``).
+    :param int blocksize:
+        Size of the buffer, in bytes. (Default: 1 MiB).
+    """
+    if mode not in ("r", "w", "a", "x", "rb", "wb", "ab", "xb"):
+        raise ValueError("Invalid mode: " + repr(mode))
+    mode = mode[0] + "b"
+    is_path = isinstance(file, (str, bytes)) or hasattr(file, "__fspath__")
+
+    if compression == "auto":
+        compression = None
+        if mode == "rb":
+            if is_path:
+                with io.open(file, "rb") as f:
+                    head = f.read(8)
+            elif hasattr(file, "peek"):
+                head = file.peek(8)
+            elif getattr(file, "seekable", lambda: False)():
+                offset = file.tell()
+                head = file.read(8)
+                file.seek(offset)
+            else:
+                raise ValueError("Cannot detect the compression of a file"
+                                 " object which cannot peek or seek")
+            for magic, name in _COMPRESSION_MAGIC:
+                if head.startswith(magic):
+                    compression = name
+                    break
+        elif is_path:
+            extension = os.path.splitext(os.fsdecode(file))[1].lower()
+            compression = _COMPRESSION_EXTENSIONS.get(extension)
+
+    if compression is None:
+        if is_path:
+            return io.open(file, mode, buffering=blocksize)
+        return file
+    module = _compression_module(compression)
+    if is_path:
+        stream = module.open(file, mode)
+    elif compression == "gzip":
+        stream = module.GzipFile(fileobj=file, mode=mode)
+    else:
+        stream = module.open(file, mode)
+    if mode == "rb":
+        return io.BufferedReader(stream, blocksize)
+    return io.BufferedWriter(stream, blocksize)
+
+
+def load_file(path, cast=cast, limits=None, stats=None, dedupe=False,
+              frozen=False, compression="auto"):
+    """
+    Parses a single message from a file, which may be compressed. See
+    :func:`open()` for the supported compression formats, and :func:`load()`
+    for the rest of the parameters.
+    """
+    with open(path, "rb", compression) as f:
+        return load(f, cast, limits, stats, dedupe, frozen)
+
+
+def dump_file(obj, path, indent=True, value=value, max_depth=None,
+              framed=False, compression="auto"):
+    """
+    Writes a message to a file, which may be compressed. See :func:`open()`
+    for the supported compression formats, and :func:`dump()` for the rest
+    of the parameters.
+    """
+    with open(path, "wb", compression) as f:
+        dump(obj, f, indent, value, max_depth, framed)
+
+
+_SCAN_DELIMITERS_RE = re.compile(b"[{}\"#]")
+_SCAN_STRING_RE = re.compile(b"[\"\\\\]")
+_SCAN_TOPLEVEL_RE = re.compile(b"[^\t\n\r ]")
+_SCAN_GARBAGE_RE = re.compile(b"{")
+
+
+class _FrameScanner(object):
+    """
+    Splits a stream of bytes fed incrementally into the spans of top-level
+    framed messages, by tracking the nesting depth of braces while skipping
+    over strings and comments. Input which is not part of a message is
+    reported as well, in separate spans.
+    """
+
+    def __init__(self, offset=0, line=1, column=1):
+        self.data = bytearray()
+        self.offset = offset  # Absolute position of data[0].
+        self.line = line      # Line and column of data[0].
+        self.column = column
+        self.pos = 0          # Scan position, relative to data[0].
+        self.start = None     # Start of the current span.
+        self.depth = 0
+        self.state = None
+
+    def feed(self, data):
+        self.data += data
+
+    @property
+    def pending(self):
+        """Whether there is an incomplete span in the buffer."""
+        return self.start is not None
+
+    def span(self, start, end):
+        return bytes(self.data[start - self.offset:end - self.offset])
+
+    def position(self, pos):
+        """Returns the line and column of a position in the buffer."""
+        pos -= self.offset
+        before = self.data[:pos]
+        newline = before.rfind(_NEWLINE)
+        if newline < 0:
+            return (self.line, self.column + pos)
+        return (self.line + before.count(_NEWLINE), pos - newline + 1)
+
+    def spans(self):
+        """
+        Yields tuples ``(start, end, is_frame)`` with the absolute positions
+        of the complete spans found in the buffered data. The data of each
+        span can be retrieved using :meth:`span()` before requesting the next
+        one, and is then discarded.
+        """
+        data = self.data
+        while True:
+            pos = self.pos
+            if self.start is None:
+                # Between messages, skip whitespace and comments.
+                m = _SCAN_TOPLEVEL_RE.search(data, pos)
+                if m is None:
+                    self._discard(len(data))
+                    return
+                pos = m.start()
+                ch = data[pos]
+                if ch == 0x23:  # "#"
+                    end = data.find(_NEWLINE, pos)
+                    if end < 0:
+                        self.pos = pos
+                        return
+                    self.pos = end + 1
+                    continue
+                self.start = pos
+                if ch == 0x7B:  # "{"
+                    self.depth = 1
+                    self.state = None
+                    pos += 1
+                else:
+                    self.state = "garbage"
+                self.pos = pos
+
+            if self.state == "garbage":
+                # Skip until the start of the next message.
+                m = _SCAN_GARBAGE_RE.search(data, self.pos)
+                if m is None:
+                    self.pos = len(data)
+                    return
+                end = m.start()
+                is_frame = False
+            else:
+                end = self._scan_frame()
+                if end is None:
+                    return
+                is_frame = True
+
+            start = self.start
+            self.start = None
+            self.pos = end
+            yield (start + self.offset, end + self.offset, is_frame)
+            self._discard(end)
+            data = self.data
+
+    def _scan_frame(self):
+        data, pos, depth, state = self.data, self.pos, self.depth, self.state
+        try:
+            while True:
+                if state == "string":
+                    m = _SCAN_STRING_RE.search(data, pos)
+                    if m is None:
+                        pos = len(data)
+                        return None
+                    pos = m.start()
+                    if data[pos] == 0x5C:  # "\"
+                        if pos + 1 >= len(data):
+                            return None  # Wait for the escaped character.
+                        pos += 2
+                    else:
+                        pos += 1
+                        state = None
+                elif state == "comment":
+                    end = data.find(_NEWLINE, pos)
+                    if end < 0:
+                        pos = len(data)
+                        return None
+                    pos = end + 1
+                    state = None
+                else:
+                    m = _SCAN_DELIMITERS_RE.search(data, pos)
+                    if m is None:
+                        pos = len(data)
+                        return None
+                    pos = m.start() + 1
+                    ch = data[pos - 1]
+                    if ch == 0x7B:  # "{"
+                        depth += 1
+                    elif ch == 0x7D:  # "}"
+                        depth -= 1
+                        if depth == 0:
+                            return pos
+                    elif ch == 0x22:  # '"'
+                        state = "string"
+                    else:
+                        state = "comment"
+        finally:
+            self.pos, self.depth, self.state = pos, depth, state
+
+    def finish(self):
+        """
+        Yields the incomplete span left at the end of the input, if any, in
+        the same way as :meth:`spans()`.
+        """
+        if self.start is not None:
+            start = self.start
+            self.start = None
+            yield (start + self.offset, len(self.data) + self.offset,
+                   self.state != "garbage")
+            self._discard(len(self.data))
+
+    def _discard(self, end):
+        self.line, self.column = self.position(end + self.offset)
+        del self.data[:end]
+        self.offset += end
+        self.pos -= end
+        if self.start is not None:
+            self.start -= end
+
+
+def _rebase_error(e, line, column):
+    """
+    Returns a copy of a :class:`ParseError` raised while parsing part of
+    the input, which starts at the given line and column of the whole input,
+    with the position of the error in the whole input.
+    """
+    if e.line == 1:
+        column += e.column - 1
+    else:
+        column = e.column
+    args = (line + e.line - 1, column, e.message)
+    if isinstance(e, LimitError):
+        return LimitError(*(args + (e.limit,)))
+    return ParseError(*args)
+
+
+def _parse_frame(data, make_parser):
+    parser = make_parser(BytesIO(data))
+    if not parser.framed:
+        parser.match(_LBRACE)  # Raises ParseError.
+    message = parser.parse_message()
+    if parser.look != _EOF:
+        parser.error("Unexpected input after message")
+    return message
+
+
+def _ignore_error(e, start, end):
+    pass
+
+
+def _parse_spans(scanner, spans, make_parser, on_error):
+    for start, end, is_frame in spans:
+        try:
+            message = _parse_frame(scanner.span(start, end), make_parser)
+        except ParseError as e:
+            # Report the position in the whole input.
+            e = _rebase_error(e, *scanner.position(start))
+            if on_error is None:
+                raise e
+            on_error(e, start, end)
+        else:
+            yield (start, end, message)
+
+
+def _scan_messages(scanner, stream, make_parser, on_error, blocksize):
+    while True:
+        for item in _parse_spans(scanner, scanner.spans(), make_parser,
+                                 on_error):
+            yield item
+        data = stream.read(blocksize)
+        if not data:
+            break
+        scanner.feed(data)
+    for item in _parse_spans(scanner, scanner.finish(), make_parser,
+                             on_error):
+        yield item
+
+
+def scan_messages(stream, cast=cast, on_error=None, blocksize=65536):
+    """
+    Parses the framed messages contained in an input stream, yielding each
+    one as a tuple ``(start, end, message)``, where `start` and `end` are
+    the offsets of the message in the stream. Reading ``end - start`` bytes
+    at `start` and passing them to :func:`loads()` parses the message again,
+    which allows building indexes of the messages in a file.
+
+    Offsets are absolute if the stream supports `.tell()`, otherwise they
+    are relative to the position where reading started.
+
+    :param stream:
+        A file-like object with a `.read(n)` method.
+    :param callable cast:
+        A value conversion function, see :class:`Parser` for details.
+    :param callable on_error:
+        Function called for each invalid message with the
+        :class:`ParseError` and the start and end offsets of the skipped
+        input. If `None`, the error is raised instead.
+    :param int blocksize:
+        Size of the blocks in which the input stream is read.
+        (Default: `65536`).
+    """
+    try:
+        offset = stream.tell()
+    except (AttributeError, OSError, ValueError):
+        offset = 0
+    return _scan_messages(_FrameScanner(offset), stream,
+                          functools.partial(Parser, cast=cast), on_error,
+                          blocksize)
+
+
+# Amount of bytes at the start of a followed file which are compared to
+# detect whether it was truncated.
+_FOLLOW_HEAD_SIZE = 64
+
+
+def _follow_truncated(f, head):
+    position = f.tell()
+    if os.fstat(f.fileno()).st_size < position:
+        return True
+    # The file may have been truncated and written again past the current
+    # position while waiting: check whether its first bytes are the same.
+    f.seek(0)
+    truncated = f.read(len(head)) != head
+    f.seek(position)
+    return truncated
+
+
+def follow(path, interval=1.0, offset=0, cast=cast, blocksize=65536,
+           on_error=None):
+    """
+    Follows a file containing framed messages as it grows, similarly to the
+    ``tail -f`` command. This is a generator which yields each message when
+    it has been completely written to the file, and waits for more data when
+    the end of the file has been reached. The generator never finishes on
+    its own.
+
+    Each message is yielded as a tuple ``(offset, message)``, where `offset`
+    is the position in the file right after the message. Passing it back as
+    the `offset` parameter allows continuing reading from that point, e.g.
+    after a restart.
+
+    When the file is truncated, reading continues from its beginning. This
+    is detected when the file becomes smaller than the position read so far,
+    or when its first bytes change, which covers files truncated and written
+    again past that position while waiting for new data. When the file is
+    replaced by a new one (e.g. after it is rotated), the rest
+    of the old file is read first, and then the new file is read from its
+    beginning, with offsets referring to the new file.
+
+    :param str path:
+        Path to the file.
+    :param float interval:
+        Time, in seconds, to wait before checking the file again when there
+        is no new data. (Default: `1.0`).
+    :param int offset:
+        Position in the file at which to start reading. If the file is smaller
+        than this, reading starts at the beginning. (Default: `0`).
+    :param callable cast:
+        A value conversion function, see :class:`Parser` for details.
+    :param int blocksize:
+        Size of the blocks in which the file is read. (Default: `65536`).
+    :param callable on_error:
+        Function called for each invalid message with the
+        :class:`ParseError` and the start and end offsets of the skipped
+        input in the file. If `None`, the error is raised instead.
+    """
+    make_parser = functools.partial(Parser, cast=cast)
+    f = None
+    try:
+        while True:
+            if f is None:
+                try:
+                    f = io.open(path, "rb")
+                except FileNotFoundError:
+                    time.sleep(interval)
+                    continue
+                if offset > os.fstat(f.fileno()).st_size:
+                    offset = 0
+                head = f.read(min(offset, _FOLLOW_HEAD_SIZE))
+                f.seek(offset)
+                scanner = _FrameScanner(offset)
+
+            data = f.read(blocksize)
+            if data:
+                if len(head) < _FOLLOW_HEAD_SIZE:
+                    head = (head + data)[:_FOLLOW_HEAD_SIZE]
+                scanner.feed(data)
+                for _, end, message in _parse_spans(scanner,
+                                                    scanner.spans(),
+                                                    make_parser, on_error):
+                    yield (end, message)
+                continue
+
+            # No new data: wait, then check whether the file was rotated or
+            # truncated before reading again.
+            time.sleep(interval)
+            current = os.fstat(f.fileno())
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                st = None
+            if st is None or (st.st_ino, st.st_dev) != \
+                    (current.st_ino, current.st_dev):
+                # Messages may have been appended to the old file after the
+                # last read, before it was replaced: read them first.
+                data = f.read()
+                f.close()
+                f, offset = None, 0
+                if data:
+                    scanner.feed(data)
+                    for _, end, message in _parse_spans(scanner,
+                                                        scanner.spans(),
+                                                        make_parser,
+                                                        on_error):
+                        yield (end, message)
+            elif _follow_truncated(f, head):
+                f.seek(0)
+                head = b""
+                scanner = _FrameScanner(0)
+    finally:
+        if f is not None:
+            f.close()
+
+
+_TOKEN_RE = re.compile(b"\n|[\t\r ]+|#[^\n]*|\"(?:[^\"\\\\]|\\\\.)*\"|"
+                       b"[^\t\n\r \\[\\]{}:,#\"][^\t\n\r \\[\\]{}:,#]*|.",
+                       re.DOTALL)
+
+
+def _tokenize(stream, blocksize):
+    """
+    Splits the input read from `stream` into tokens, yielding tuples
+    ``(token, line, column)``. Whitespace and comments are included, with
+    newlines as separate tokens. Only one token is buffered at a time.
+    """
+    data = b""
+    pos = 0
+    eof = False
+    line, line_start = 1, -1  # Position of the line, as in the Parser.
+    offset = 0  # Absolute position of data[0].
+    while True:
+        m = _TOKEN_RE.match(data, pos)
+        if m is None or (not eof and (m.end() == len(data) or
+                                      data[pos:pos + 1] == _DQUOTE and
+                                      m.end() == pos + 1)):
+            # The token may continue in the following block.
+            if eof:
+                return
+            more = stream.read(blocksize)
+            if len(more) == 0:
+                eof = True
+            offset += pos
+            data = data[pos:] + more
+            pos = 0
+            continue
+        token = m.group()
+        if token == _DQUOTE:
+            raise ParseError(line, offset + pos - line_start,
+                             "Unterminated string")
+        yield token, line, offset + pos - line_start
+        if token == _NEWLINE:
+            line, line_start = line + 1, offset + pos - 1
+        pos = m.end()
+
+
+# States of the reformatter.
+_FMT_TOP, _FMT_KEY, _FMT_SEPARATOR, _FMT_VALUE, _FMT_ANNOTATION, \
+    _FMT_ITEM = range(6)
+_FMT_CLOSING = {_FRAME_DICT: _RBRACE, _FRAME_LIST: _RBRACKET}
+
+
+def reformat(source, dest, indent=True, comments=False, blocksize=65536):
+    """
+    Rewrites HiPack messages read from a stream with a different layout,
+    without parsing the values. The input is processed as a stream of
+    tokens, so arbitrarily large inputs (e.g. framed messages, which are
+    all written back) can be handled using a constant amount of memory.
+
+    The output has the same layout as :func:`dump()`, except for the order
+    of the dictionary keys, which is kept. Literal values are copied as
+    they are, and the structure of the input is checked only as much as
+    needed to reformat it.
+
+    :param source:
+        A file-like object with a `.read(n)` method, returning `bytes`.
+    :param dest:
+        A file-like object with a `.write()` method, accepting `bytes`.
+    :param bool indent:
+        Whether to write indented output. (Default: `True`).
+    :param bool comments:
+        Whether to keep comments. Comments are written in their own line,
+        before the item which follows them. (Default: `False`).
+    :param int blocksize:
+        Size of the blocks read from the input and written to the output.
+    """
+    out = bytearray()
+    top = 0 if indent else -1
+    stack = []   # Frames: (kind, level, inner level, suffix).
+    pending = []  # Comments to be written before the next item.
+    state, key, annotations = _FMT_TOP, None, []
+    adjacent = False  # Whether the previous token is immediately before.
+    need_space = False  # Whether a separator is required after a value.
+
+    def flush_comments(level, in_list):
+        for comment in pending:
+            if level < 0:
+                out.extend(comment + _NEWLINE)
+            elif in_list:
+                out.extend(_NEWLINE + _SPACE * (level * 2) + comment)
+            else:
+                out.extend(_SPACE * (level * 2) + comment + _NEWLINE)
+        del pending[:]
+
+    def start_value(token, level, suffix):
+        if token == _LBRACE:
+            out.extend(_LBRACE)
+            if level >= 0:
+                out.extend(_NEWLINE)
+            stack.append((_FRAME_DICT, level,
+                          level + 1 if level >= 0 else level, suffix))
+            return _FMT_KEY
+        elif token == _LBRACKET:
+            out.extend(_LBRACKET)
+            stack.append((_FRAME_LIST, level,
+                          level + 1 if level >= 0 else level, suffix))
+            return _FMT_ITEM
+        elif token[0] in b"]}:,":
+            raise ParseError(line, column, "Value expected")
+        out.extend(token)
+        out.extend(suffix)
+        return None
+
+    for token, line, column in _tokenize(source, blocksize):
+        if len(out) >= blocksize:
+            dest.write(out)
+            del out[:]
+        first = token[0]
+        if first in b"\t\n\r ":
+            adjacent = need_space = False
+            continue
+        elif first == 0x23:  # "#"
+            if comments:
+                pending.append(token.rstrip())
+            adjacent = need_space = False
+            continue
+        elif need_space and first not in b",]}":
+            raise ParseError(line, column, "Separator expected")
+
+        need_space = False
+        if state == _FMT_TOP:
+            flush_comments(top, False)
+            if token != _LBRACE:
+                # Unframed message, its items are written without braces.
+                stack.append((_FRAME_DICT, top, top, None))
+                state = _FMT_KEY
+            else:
+                out.extend(_LBRACE)
+                if indent:
+                    out.extend(_NEWLINE)
+                stack.append((_FRAME_DICT, top, top + 1 if indent else top,
+                              _NEWLINE))
+                state = _FMT_KEY
+                adjacent = True
+                continue
+
+        if state == _FMT_KEY or state == _FMT_ITEM:
+            kind, level, inner, suffix = stack[-1]
+            if token == _COMMA:
+                adjacent = False
+                continue
+            if token == _FMT_CLOSING[kind] and suffix is not None:
+                flush_comments(inner, kind == _FRAME_LIST)
+                if level >= 0:
+                    if kind == _FRAME_LIST:
+                        out.extend(_NEWLINE)
+                    out.extend(_SPACE * (level * 2))
+                out.extend(token)
+                out.extend(suffix)
+                stack.pop()
+                if stack:
+                    state = _FMT_KEY if stack[-1][0] == _FRAME_DICT \
+                        else _FMT_ITEM
+                    need_space = True
+                else:
+                    state = _FMT_TOP
+                adjacent = True
+                continue
+            if kind == _FRAME_DICT:
+                if first in b"[]{}:,\"":
+                    raise ParseError(line, column, "key expected")
+                flush_comments(inner, False)
+                key, annotations = token, []
+                state = _FMT_SEPARATOR
+                adjacent = True
+                continue
+            flush_comments(inner, True)
+            annotations = []
+            state = _FMT_VALUE
+        elif state == _FMT_SEPARATOR:
+            state = _FMT_VALUE
+            if token == _COLON and adjacent:
+                adjacent = False
+                continue
+            elif adjacent and token not in (_LBRACE, _LBRACKET):
+                raise ParseError(line, column, "missing separator")
+        elif state == _FMT_ANNOTATION:
+            if first in b"[]{}:,\"":
+                raise ParseError(line, column, "key expected")
+            annotations.append(token)
+            state = _FMT_VALUE
+            adjacent = True
+            continue
+
+        if state == _FMT_VALUE:
+            if token == _COLON:
+                state = _FMT_ANNOTATION
+                adjacent = True
+                continue
+            kind, level, inner, suffix = stack[-1]
+            if kind == _FRAME_DICT:
+                out.extend(_SPACE * (inner * 2) if inner >= 0 else b"")
+                out.extend(key)
+                out.extend(_COLON)
+                suffix = _NEWLINE if inner >= 0 else _SPACE
+            else:
+                if inner >= 0:
+                    out.extend(_NEWLINE + _SPACE * (inner * 2))
+                suffix = b"" if inner >= 0 else _COMMA
+            if annotations:
+                out.extend(_COLON + _COLON.join(annotations) + _SPACE)
+            elif kind == _FRAME_DICT and inner >= 0:
+                out.extend(_SPACE)
+            state = start_value(token, inner, suffix)
+            if state is None:
+                state = _FMT_KEY if kind == _FRAME_DICT else _FMT_ITEM
+                need_space = True
+            adjacent = True
+
+    if state == _FMT_TOP or (state == _FMT_KEY and len(stack) == 1 and
+                             stack[0][3] is None):
+        flush_comments(top, False)
+    else:
+        raise ParseError(line, column, "Unexpected end of input")
+    dest.write(out)
+
+
+class _QueryNode(object):
+    """
+    Node in the tree of paths of a query. Values which reach a node are
+    collected under the identifiers of the paths which end at the node, if
+    any, and otherwise only the items which lead to other nodes are parsed.
+    """
+
+    __slots__ = ("ids", "children", "any", "merged")
+
+    def __init__(self):
+        self.ids = []
+        self.children = {}
+        self.any = None  # Node for the "*" wildcard.
+        self.merged = {}
+
+    def add(self, steps, path_id):
+        node = self
+        for step in steps:
+            if step == "*":
+                if node.any is None:
+                    node.any = _QueryNode()
+                node = node.any
+            else:
+                node = node.children.setdefault(step, _QueryNode())
+        node.ids.append(path_id)
+
+    def child(self, key):
+        node = self.children.get(key)
+        if self.any is None or node is None:
+            return self.any if node is None else node
+        # Both the key and the wildcard match: combine the sub-trees.
+        merged = self.merged.get(key)
+        if merged is None:
+            merged = self.merged[key] = _QueryNode._merge(node, self.any)
+        return merged
+
+    @staticmethod
+    def _merge(a, b):
+        if a is None or b is None:
+            return b if a is None else a
+        node = _QueryNode()
+        node.ids = a.ids + b.ids
+        for key in set(a.children) | set(b.children):
+            node.children[key] = _QueryNode._merge(a.children.get(key),
+                                                   b.children.get(key))
+        node.any = _QueryNode._merge(a.any, b.any)
+        return node
+
+    @property
+    def leaf(self):
+        return not self.children and self.any is None
+
+
+def _query_python(obj, node, results):
+    # Continues matching inside a value which has been parsed already.
+    if isinstance(obj, _MAPPING_TYPES):
+        items = obj.items()
+    elif isinstance(obj, _SEQUENCE_TYPES):
+        items = ((str(i), v) for i, v in enumerate(obj))
+    else:
+        return
+    for key, v in items:
+        child = node.child(key)
+        if child is not None:
+            for path_id in child.ids:
+                results.append((path_id, v))
+            if not child.leaf:
+                _query_python(v, child, results)
+
+
+def _query_value(parser, reader, node, results):
+    if node is not None and node.ids:
+        value = parser.parse_value()
+        for path_id in node.ids:
+            results.append((path_id, value))
+        if not node.leaf:
+            _query_python(value, node, results)
+        return
+
+    parser.parse_annotations()
+    if node is None and parser.look in (_LBRACE, _LBRACKET):
+        reader.skip(parser)
+    elif parser.look == _LBRACE:
+        parser.enter_container()
+        parser.nextchar()
+        parser.skip_whitespace()
+        _query_items(parser, reader, node, _RBRACE, results)
+        parser.match(_RBRACE)
+        parser.depth -= 1
+    elif parser.look == _LBRACKET:
+        parser.enter_container()
+        parser.nextchar()
+        parser.skip_whitespace()
+        index = 0
+        while parser.look != _RBRACKET and parser.look != _EOF:
+            _query_value(parser, reader, node.child(str(index)), results)
+            index += 1
+            got_whitespace = _is_hipack_whitespace(parser.look)
+            parser.skip_whitespace()
+            if parser.look == _COMMA:
+                parser.nextchar()
+            elif not got_whitespace and \
+                    not _is_hipack_whitespace(parser.look):
+                break
+            parser.skip_whitespace()
+        parser.match(_RBRACKET)
+        parser.depth -= 1
+    else:
+        parser.parse_value()  # Literal values are cheap to parse.
+
+
+def _query_items(parser, reader, node, eos, results):
+    while parser.look != eos and parser.look != _EOF:
+        key = parser.parse_key()
+        if _is_hipack_whitespace(parser.look):
+            parser.skip_whitespace()
+        elif parser.look == _COLON:
+            parser.nextchar()
+            parser.skip_whitespace()
+        elif parser.look not in (_LBRACE, _LBRACKET):
+            parser.error("missing separator")
+        _query_value(parser, reader, node.child(key), results)
+        if parser.look == _COMMA:
+            parser.nextchar()
+        elif parser.look != eos and not _is_hipack_whitespace(parser.look):
+            break
+        parser.skip_whitespace()
+
+
+_SKIP_DELIMITERS_RE = re.compile(b"[\\[\\]{}\"#]")
+
+
+class _QueryReader(object):
+    """
+    Buffered input for a :class:`Parser`, which can skip over containers
+    without handing each character to the parser. Optionally, the input
+    consumed by the parser is recorded.
+    """
+
+    def __init__(self, stream, blocksize):
+        self.stream = stream
+        self.blocksize = blocksize
+        self.data = b""
+        self.pos = 0
+        self.record = None
+
+    def _fill(self):
+        more = self.stream.read(self.blocksize)
+        if len(more) == 0:
+            return False
+        self.data = self.data[self.pos:] + more
+        self.pos = 0
+        return True
+
+    def read(self, n):
+        if self.pos >= len(self.data) and not self._fill():
+            return _EOF
+        data = self.data[self.pos:self.pos + n]
+        self.pos += len(data)
+        if self.record is not None:
+            self.record += data
+        return data
+
+    def _consume(self, parser, end):
+        data, pos = self.data, self.pos
+        if self.record is not None:
+            self.record += data[pos:end]
+        lines = data.count(_NEWLINE, pos, end)
+        if lines:
+            parser.line += lines
+            parser.column = end - data.rfind(_NEWLINE, pos, end)
+        else:
+            parser.column += end - pos
+        self.pos = end
+
+    def skip(self, parser):
+        """
+        Skips the rest of the container opened by the current character
+        of the parser, and reads the character after it.
+        """
+        depth, state = 1, None
+        data, pos = self.data, self.pos
+        while True:
+            if state == _DQUOTE:
+                m = _SCAN_STRING_RE.search(data, pos)
+                if m is not None and data[m.start()] == 0x22:  # '"'
+                    pos, state = m.end(), None
+                    continue
+                elif m is not None and m.start() + 1 < len(data):
+                    pos = m.start() + 2  # Skip the escaped character.
+                    continue
+                pos = len(data) if m is None else m.start()
+            elif state == _OCTOTHORPE:
+                end = data.find(_NEWLINE, pos)
+                if end >= 0:
+                    pos, state = end, None
+                    continue
+                pos = len(data)
+            else:
+                m = _SKIP_DELIMITERS_RE.search(data, pos)
+                if m is not None:
+                    pos = m.end()
+                    ch = data[m.start():pos]
+                    if ch == _LBRACE or ch == _LBRACKET:
+                        depth += 1
+                    elif ch == _RBRACE or ch == _RBRACKET:
+                        depth -= 1
+                        if depth == 0:
+                            break
+                    else:
+                        state = ch
+                    continue
+                pos = len(data)
+
+            # Need more input.
+            self._consume(parser, pos)
+            if not self._fill():
+                parser.error("Unterminated container")
+            data, pos = self.data, self.pos
+
+        self._consume(parser, pos)
+        parser.nextchar()
+
+
+_WHERE_TOKEN_RE = re.compile(r'\s*(?:(==|!=|<=|>=|<|>|\(|\))|'
+                             r'("(?:[^"\\]|\\.)*")|([^\s()=!<>"]+))')
+_WHERE_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+
+def _compile_where(expression, root, first_id):
+    """
+    Compiles a filter expression into a function which is passed a
+    dictionary mapping path identifiers to the lists of values found for
+    them. The paths used in the expression are added to the `root` node.
+    """
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        m = _WHERE_TOKEN_RE.match(expression, pos)
+        if m is None or m.end() == pos:
+            raise ValueError("Invalid filter expression: " + expression)
+        tokens.append(m.group(1, 2, 3))
+        pos = m.end()
+    tokens.append((None, None, None))
+    state = {"pos": 0, "next_id": first_id}
+
+    def peek():
+        return tokens[state["pos"]]
+
+    def advance():
+        token = tokens[state["pos"]]
+        state["pos"] += 1
+        return token
+
+    def expect_word(word):
+        if peek()[2] == word:
+            advance()
+            return True
+        return False
+
+    def literal():
+        op, string, word = advance()
+        text = string or word
+        if text is None:
+            raise ValueError("Value expected in filter: " + expression)
+        try:
+            parser = Parser(BytesIO(text.encode("utf-8")))
+            value = parser.parse_value()
+            if parser.look != _EOF:
+                parser.error("Unexpected input after value")
+        except ParseError:
+            raise ValueError("Invalid value in filter: " + text)
+        return value
+
+    def atom():
+        op, string, word = advance()
+        if op == "(":
+            result = disjunction()
+            if advance()[0] != ")":
+                raise ValueError("Missing ')' in filter: " + expression)
+            return result
+        if word is None or word in ("and", "or", "not"):
+            raise ValueError("Path expected in filter: " + expression)
+        path_id = state["next_id"]
+        state["next_id"] += 1
+        root.add(_split_path(word), path_id)
+        op = peek()[0]
+        if op not in _WHERE_OPERATORS:
+            return lambda values: bool(values.get(path_id))
+        advance()
+        compare, expected = _WHERE_OPERATORS[op], literal()
+
+        def comparison(values):
+            for v in values.get(path_id, ()):
+                try:
+                    if compare(v, expected):
+                        return True
+                except TypeError:
+                    pass  # Values of different types are not ordered.
+            return False
+        return comparison
+
+    def negation():
+        if expect_word("not"):
+            operand = negation()
+            return lambda values: not operand(values)
+        return atom()
+
+    def conjunction():
+        operands = [negation()]
+        while expect_word("and"):
+            operands.append(negation())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda values: all(f(values) for f in operands)
+
+    def disjunction():
+        operands = [conjunction()]
+        while expect_word("or"):
+            operands.append(conjunction())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda values: any(f(values) for f in operands)
+
+    predicate = disjunction()
+    if peek() != (None, None, None):
+        raise ValueError("Unexpected input in filter: " + expression)
+    return predicate
+
+
+class Query(object):
+    """
+    Selects values from HiPack messages, without building the parts of the
+    messages which are not needed.
+
+    A path is a string with keys separated by dots (e.g. ``"a.b.c"``),
+    where ``*`` matches any key of a dictionary or item of a list, and
+    numbers match the items of lists at that position. The ``"."`` path
+    selects the whole message.
+
+    A filter expression selects the messages for which it is true. It is
+    composed of comparisons of a path with a value, using the ``==``,
+    ``!=``, ``<``, ``<=``, ``>`` and ``>=`` operators, which are true when
+    any of the values at the path satisfies them. Values are written as in
+    HiPack (e.g. ``"text"``, ``42``, ``True``). A path alone is true when it
+    matches any value. Expressions can be combined using ``and``, ``or``,
+    ``not``, and parentheses: ``level == "error" and not retried``.
+
+    The query is compiled when the object is created, and the same object
+    can be used multiple times.
+
+    :param str path:
+        Path of the values to select. (Default: the whole message).
+    :param str where:
+        Filter expression. (Default: `None`, all messages are used).
+    :raises ValueError: If the path or the filter expression are invalid.
+    """
+
+    def __init__(self, path=None, where=None):
+        self.root = _QueryNode()
+        if path is None or path == ".":
+            self.path = None
+        else:
+            self.path = _split_path(path)
+            self.root.add(self.path, 0)
+        self.where = None
+        if where is not None:
+            self.where = _compile_where(where, self.root, 1)
+
+    def select(self, stream, cast=cast, blocksize=65536):
+        """
+        Yields the values selected from each of the messages read from a
+        stream, which may contain multiple framed messages.
+
+        :param stream:
+            A file-like object with a `.read(n)` method.
+        :param callable cast:
+            A value conversion function, see :class:`Parser` for details.
+        :param int blocksize:
+            Size of the blocks in which the input stream is read.
+        """
+        if self.path is None and self.where is None:
+            for message in Parser(stream, cast).messages():
+                yield message
+            return
+
+        reader = _QueryReader(stream, blocksize)
+        # Without a path, messages which match the filter are parsed again.
+        record = self.path is None
+        if record:
+            reader.record = bytearray()
+        parser = Parser(reader, cast)
+        framed = parser.framed
+        while not framed or parser.look != _EOF:
+            results = []
+            if framed:
+                if record:
+                    reader.record = bytearray(_LBRACE)
+                parser.match(_LBRACE)
+                parser.skip_whitespace()
+                _query_items(parser, reader, self.root, _RBRACE, results)
+                data = record and bytes(reader.record)
+                parser.match(_RBRACE)
+                parser.skip_whitespace()
+            else:
+                _query_items(parser, reader, self.root, _EOF, results)
+                data = record and bytes(reader.record)
+
+            if self.where is not None:
+                values = {}
+                for path_id, v in results:
+                    values.setdefault(path_id, []).append(v)
+                if not self.where(values):
+                    results = ()
+                elif record:
+                    yield Parser(BytesIO(data), cast).parse_message()
+            if not record:
+                for path_id, v in results:
+                    if path_id == 0:
+                        yield v
+            if not framed:
+                break
+
+
+def query(stream, path=None, where=None, cast=cast):
+    """
+    Yields the values selected from the messages read from a stream. This
+    is a shortcut for ``Query(path, where).select(stream, cast)``, see
+    :class:`Query` for details.
+    """
+    return Query(path, where).select(stream, cast)
+
+
+_SKIM_SPACE_RE = re.compile(b"(?:[\t\n\r ]+|#[^\n]*)*")
+_SKIM_KEY_RE = re.compile(b"[^\t\n\r \\[\\]{}:,#]+")
+_SKIM_SCALAR_RE = re.compile(b"[^\t\n\r ,\\]}#]*")
+_SKIM_NESTED_RE = re.compile(b"[\\[\\]{}\"#]")
+_SKIM_SEPARATORS = (_TAB, _NEWLINE, _RETURN, _SPACE, _OCTOTHORPE)
+
+
+def _skim_position(data, pos):
+    # Same as the Parser, which counts newlines at the start of the lines.
+    before = data[:pos]
+    newline = before.rfind(_NEWLINE)
+    column = pos + 1 if newline < 0 else pos - newline + 1
+    return (before.count(_NEWLINE) + 1, column)
+
+
+def _skim_error(data, pos, message):
+    line, column = _skim_position(data, pos)
+    raise ParseError(line, column, message)
+
+
+def _skim_value_end(data, pos):
+    ch = data[pos:pos + 1]
+    if ch == _DQUOTE:
+        pos += 1
+        while True:
+            m = _SCAN_STRING_RE.search(data, pos)
+            if m is None:
+                _skim_error(data, len(data), "Unterminated string")
+            if data[m.start():m.end()] == _DQUOTE:
+                return m.end()
+            pos = m.end() + 1  # Skip the escaped character.
+    elif ch == _LBRACE or ch == _LBRACKET:
+        depth = 0
+        while True:
+            m = _SKIM_NESTED_RE.search(data, pos)
+            if m is None:
+                _skim_error(data, len(data), "Unterminated container")
+            pos = m.end()
+            ch = data[m.start():pos]
+            if ch == _LBRACE or ch == _LBRACKET:
+                depth += 1
+            elif ch == _RBRACE or ch == _RBRACKET:
+                depth -= 1
+                if depth == 0:
+                    return pos
+            elif ch == _DQUOTE:
+                pos = _skim_value_end(data, m.start())
+            else:
+                pos = _SKIM_SPACE_RE.match(data, m.start()).end()
+    else:
+        return _SKIM_SCALAR_RE.match(data, pos).end()
+
+
+def _skim_items(data, pos, eos):
+    """
+    Finds the keys of the dictionary items which start at `pos` and the
+    spans of their values, without parsing them. Returns a dictionary which
+    maps keys to ``(key_start, start, value_start, end, annotations)``
+    tuples, where `start` includes the annotations of the value, and the
+    position
+    after the last item, which is where `eos` is expected.
+    """
+    spans = {}
+    while True:
+        pos = _SKIM_SPACE_RE.match(data, pos).end()
+        ch = data[pos:pos + 1]
+        if ch == eos or ch == _EOF:
+            break
+        m = _SKIM_KEY_RE.match(data, pos)
+        if m is None:
+            _skim_error(data, pos, "key expected")
+        key_start = pos
+        key = data[pos:m.end()].decode("utf-8")
+        pos = m.end()
+        ch = data[pos:pos + 1]
+        if ch == _COLON:
+            pos += 1
+        elif ch not in _SKIM_SEPARATORS and ch != _LBRACE and \
+                ch != _LBRACKET:
+            _skim_error(data, pos, "missing separator")
+        pos = start = _SKIM_SPACE_RE.match(data, pos).end()
+
+        annotations = set()
+        while data[pos:pos + 1] == _COLON:
+            m = _SKIM_KEY_RE.match(data, pos + 1)
+            if m is None:
+                _skim_error(data, pos + 1, "key expected")
+            annotations.add(data[pos + 1:m.end()].decode("utf-8"))
+            pos = _SKIM_SPACE_RE.match(data, m.end()).end()
+
+        end = _skim_value_end(data, pos)
+        spans[key] = (key_start, start, pos, end, annotations)
+        pos = end
+        ch = data[pos:pos + 1]
+        if ch == _COMMA:
+            pos += 1
+        elif ch != eos and ch not in _SKIM_SEPARATORS:
+            break
+    return spans, pos
+
+
+def _parse_span(data, start, end, cast):
+    parser = Parser(BytesIO(data[start:end]), cast)
+    try:
+        value = parser.parse_value()
+        if parser.look != _EOF:
+            parser.error("Unexpected input after value")
+    except ParseError as e:
+        # Report the position in the whole input.
+        raise _rebase_error(e, *_skim_position(data, start))
+    return value
+
+
+class LazyDict(Mapping):
+    """
+    Read-only mapping returned by :func:`load_lazy()`. The positions of the
+    items are found when the mapping is created, but each value is parsed
+    only when it is accessed for the first time, and then kept.
+    """
+
+    def __init__(self, data, spans, cast, nested):
+        self._data = data
+        self._spans = spans
+        self._values = {}
+        self._cast = cast
+        self._nested = nested
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        value = self._values[key] = self._parse(*self._spans[key][1:])
+        return value
+
+    def _parse(self, start, value_start, end, annotations):
+        data = self._data
+        if self._nested and data[value_start:value_start + 1] == _LBRACE:
+            spans, pos = _skim_items(data, value_start + 1, _RBRACE)
+            value = LazyDict(data, spans, self._cast, True)
+            annotations = frozenset(annotations | set((ANNOT_DICT,)))
+            return self._cast(annotations, None, value)
+        return _parse_span(data, start, end, self._cast)
+
+    def __contains__(self, key):
+        return key in self._spans
+
+    def __iter__(self):
+        return iter(self._spans)
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __repr__(self):
+        return "LazyDict(" + repr(list(self._spans)) + ")"
+
+
+def load_lazy(path_or_bytes, cast=cast, nested=False):
+    """
+    Loads a message from a file or a string, deferring the parsing of each
+    value until it is accessed. The input is only skimmed to find where
+    the items of the message are, which is much faster than parsing it
+    fully when only a few of the values are used. Syntax errors inside
+    a value are reported when it is accessed.
+
+    Files are mapped into memory instead of being read, and the mapping is
+    kept open as long as the returned object (or any of the values of
+    `nested` mappings) is in use.
+
+    :param path_or_bytes:
+        Path to the input file, or a `bytes` object with the message.
+    :param callable cast:
+        A value conversion function, see :class:`Parser` for details.
+    :param bool nested:
+        When `True`, dictionaries contained in the message are returned
+        as lazy mappings as well, and the `cast` function is called with
+        them as value. (Default: `False`).
+    :return:
+        A :class:`LazyDict` object.
+    """
+    if isinstance(path_or_bytes, (bytes, bytearray, memoryview)):
+        data = bytes(path_or_bytes)
+    else:
+        with io.open(path_or_bytes, "rb") as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = b""  # Empty files cannot be mapped.
+
+    pos = _SKIM_SPACE_RE.match(data, 0).end()
+    if data[pos:pos + 1] == _LBRACE:
+        spans, pos = _skim_items(data, pos + 1, _RBRACE)
+        if data[pos:pos + 1] != _RBRACE:
+            _skim_error(data, pos, "'}' was expected")
+    else:
+        spans, pos = _skim_items(data, pos, _EOF)
+    return LazyDict(data, spans, cast, nested)
+
+
+_LINE_INDENT_RE = re.compile(b"[ \t]*")
+
+
+def _line_indent(data, pos):
+    start = data.rfind(_NEWLINE, 0, pos) + 1
+    return bytes(data[start:_LINE_INDENT_RE.match(data, start).end()])
+
+
+def _split_path(path):
+    keys = path.split(".") if isinstance(path, str) else list(path)
+    if not keys or not all(keys):
+        raise ValueError("Invalid path: " + repr(path))
+    return keys
+
+
+class Document(object):
+    """
+    Editor for HiPack messages which preserves their formatting. Only the
+    parts of the input which are modified are rewritten, leaving the rest
+    (including comments, spacing, and the order of the keys) untouched.
+
+    Values are located using paths, which are either a sequence of keys, or
+    a string with the keys separated by dots (e.g. ``"a.b.c"``). Each key
+    except the last one must refer to a dictionary.
+
+    :param path_or_bytes:
+        Path to the input file, or a `bytes` object with the message. The
+        input is validated only as much as needed to locate the values.
+    :param callable cast:
+        A value conversion function used by :meth:`get()`, see
+        :class:`Parser` for details.
+    :param callable value:
+        A Python object conversion function used by :meth:`set()`, see
+        :func:`dump()` for details.
+    :attribute path:
+        Path to the input file, or `None` if the input was a `bytes` object.
+    """
+
+    def __init__(self, path_or_bytes, cast=cast, value=value):
+        if isinstance(path_or_bytes, (bytes, bytearray, memoryview)):
+            self.path = None
+            self._data = bytearray(path_or_bytes)
+        else:
+            self.path = path_or_bytes
+            with io.open(path_or_bytes, "rb") as f:
+                self._data = bytearray(f.read())
+        self.cast = cast
+        self.value = value
+        self._root = None   # Items of the message: (spans, open, close).
+        self._dirty = None  # Position of the first modified byte.
+
+    @property
+    def data(self):
+        """The contents of the document, as a `bytes` object."""
+        return bytes(self._data)
+
+    def _root_items(self):
+        if self._root is None:
+            data = self._data
+            pos = _SKIM_SPACE_RE.match(data, 0).end()
+            if data[pos:pos + 1] == _LBRACE:
+                spans, end = _skim_items(data, pos + 1, _RBRACE)
+                if data[end:end + 1] != _RBRACE:
+                    _skim_error(data, end, "'}' was expected")
+                self._root = (spans, pos, end)
+            else:
+                self._root = (_skim_items(data, pos, _EOF)[0], None,
+                              len(data))
+        return self._root
+
+    def _find(self, keys):
+        """
+        Returns the items ``(spans, open, close)`` of the innermost existing
+        dictionary along the path given by `keys`, its nesting level, and
+        the keys which remain to be looked up in it. The last key is never
+        looked up.
+        """
+        data = self._data
+        spans, open_pos, close = self._root_items()
+        for level, key in enumerate(keys[:-1]):
+            if key not in spans:
+                return (spans, open_pos, close), level, keys[level:]
+            value_start = spans[key][2]
+            if data[value_start:value_start + 1] != _LBRACE:
+                raise ValueError("Not a dictionary: " +
+                                 ".".join(keys[:level + 1]))
+            spans, close = _skim_items(data, value_start + 1, _RBRACE)
+            open_pos = value_start
+        return (spans, open_pos, close), len(keys) - 1, keys[-1:]
+
+    def _splice(self, start, end, data, level):
+        self._data[start:end] = data
+        if self._dirty is None or start < self._dirty:
+            self._dirty = start
+        if self._root is None:
+            return
+        if level == 0:
+            # Items were added or removed from the message.
+            self._root = None
+            return
+        delta = len(data) - (end - start)
+        spans, open_pos, close = self._root
+        for key, span in spans.items():
+            if span[0] >= end:
+                spans[key] = (span[0] + delta, span[1] + delta,
+                              span[2] + delta, span[3] + delta, span[4])
+            elif span[3] >= end:
+                spans[key] = span[:3] + (span[3] + delta, span[4])
+        self._root = (spans, open_pos, close + delta)
+
+    def _encode(self, obj, multiline, indent):
+        output = BytesIO()
+        _dump_value(obj, output, 0 if multiline else -1, self.value)
+        return output.getvalue().replace(_NEWLINE, _NEWLINE + indent)
+
+    def get(self, path):
+        """
+        Returns the value at `path`, parsing it.
+
+        :raises KeyError: If there is no value at `path`.
+        """
+        keys = _split_path(path)
+        (spans, _, _), level, rest = self._find(keys)
+        if len(rest) > 1 or rest[0] not in spans:
+            raise KeyError(path)
+        span = spans[rest[0]]
+        return _parse_span(self._data, span[1], span[3], self.cast)
+
+    def __contains__(self, path):
+        try:
+            keys = _split_path(path)
+            (spans, _, _), level, rest = self._find(keys)
+        except ValueError:
+            return False
+        return len(rest) == 1 and rest[0] in spans
+
+    def set(self, path, obj):
+        """
+        Sets the value at `path`, which is converted using the `value`
+        function of the document. Existing values are replaced keeping
+        their annotations, unless the `value` function returns annotations
+        for the new value; otherwise a new item is added at the end of the
+        dictionary, creating the missing intermediate dictionaries.
+        """
+        keys = _split_path(path)
+        for key in keys:
+            _check_key(key)
+        data = self._data
+        (spans, open_pos, close), level, rest = self._find(keys)
+        multiline = open_pos is None or \
+            data.find(_NEWLINE, open_pos, close) >= 0
+
+        annotations = b""
+        if len(rest) == 1:
+            # Values inside missing intermediate dictionaries are converted
+            # by the dumper, like any other dictionary item.
+            obj, annots = self.value(obj)
+            if annots is not None and len(annots) > 0:
+                output = BytesIO()
+                _dump_annotations(annots, output)
+                annotations = output.getvalue()
+
+        if len(rest) == 1 and rest[0] in spans:
+            _, start, value_start, end, _ = spans[rest[0]]
+            indent = _line_indent(data, spans[rest[0]][0])
+            encoded = self._encode(obj, multiline, indent)
+            if annotations:
+                # The cached spans do not include the new annotations.
+                self._splice(start, end, annotations + _SPACE + encoded, 0)
+            else:
+                self._splice(value_start, end, encoded, level + 1)
+            return
+
+        for key in reversed(rest[1:]):
+            obj = {key: obj}
+        if spans:
+            last = max(spans.values(), key=lambda span: span[3])
+            indent = _line_indent(data, last[0])
+            if multiline:
+                # Add a line after the last item, keeping trailing comments.
+                pos = data.find(_NEWLINE, last[3], close)
+                if pos < 0:
+                    pos = close
+                prefix = _NEWLINE + indent
+            else:
+                pos, prefix = last[3], _SPACE
+        elif open_pos is None:
+            pos, prefix, indent = close, b"", b""
+            if close > 0 and data[close - 1:close] != _NEWLINE:
+                prefix = _NEWLINE
+        else:
+            pos, prefix, indent = open_pos + 1, b"", b""
+            if multiline:
+                indent = _line_indent(data, open_pos) + b"  "
+                prefix = _NEWLINE + indent
+        item = prefix + _check_key(rest[0]) + _COLON + annotations + \
+            _SPACE + self._encode(obj, multiline, indent)
+        if open_pos is None and not spans:
+            item += _NEWLINE
+        self._splice(pos, pos, item, level)
+
+    def delete(self, path):
+        """
+        Removes the item at `path`. When the item is alone in its line, the
+        whole line is removed, including a trailing comment.
+
+        :raises KeyError: If there is no value at `path`.
+        """
+        keys = _split_path(path)
+        data = self._data
+        (spans, _, _), level, rest = self._find(keys)
+        if len(rest) > 1 or rest[0] not in spans:
+            raise KeyError(path)
+        start, _, _, end, _ = spans[rest[0]]
+        if data[end:end + 1] == _COMMA:
+            end += 1
+        end = _LINE_INDENT_RE.match(data, end).end()
+        line_start = data.rfind(_NEWLINE, 0, start) + 1
+        if not data[line_start:start].strip():
+            line_end = end
+            if data[end:end + 1] == _OCTOTHORPE:
+                line_end = data.find(_NEWLINE, end)
+                if line_end < 0:
+                    line_end = len(data)
+            if data[line_end:line_end + 1] in (_NEWLINE, _EOF):
+                # Remove the whole line, along with its trailing comment.
+                start, end = line_start, line_end + 1
+        self._splice(start, end, b"", level)
+
+    def save(self, path=None):
+        """
+        Writes the document to a file. When writing to the file from which
+        the document was read, only the part after the first modification
+        is written.
+
+        :param str path:
+            Path to the output file. (Default: the input file).
+        """
+        if path is None:
+            path = self.path
+            if path is None:
+                raise ValueError("Document was not read from a file")
+        if path != self.path:
+            with io.open(path, "wb") as f:
+                f.write(self._data)
+        elif self._dirty is not None:
+            with io.open(path, "r+b") as f:
+                f.seek(self._dirty)
+                f.write(self._data[self._dirty:])
+                f.truncate()
+            self._dirty = None
+
+
+# Identifies the format of cache files written by load_cached(). Must be
+# changed when the contents of the header change.
+_CACHE_MAGIC = b"HIC1"
+
+
+def _stat_signature(st):
+    return (st.st_mtime_ns, st.st_size)
+
+
+def load_cached(path, cast=cast, cast_id=None, cache_path=None):
+    """
+    Parses a single message from a file, keeping a cache of the result in a
+    separate file. Further calls use the cache, avoiding parsing the message
+    again, unless the file has been modified.
+
+    The cache file is considered valid when the modification time and size
+    of the input file, the version of the module, and the identifier of the
+    `cast` function match the ones recorded when the cache was written.
+    Otherwise, the file is parsed and the cache written anew. Errors writing
+    the cache are ignored, and invalid cache files are ignored as well.
+
+    The cache is stored using :mod:`pickle`, which means that it must be
+    written in a location which cannot be modified by untrusted parties, and
+    that values returned by the `cast` function must be picklable.
+
+    :param path:
+        Path to the input file, as a `str` or a path-like object.
+    :param callable cast:
+        A value conversion function, see :class:`Parser` for details.
+    :param str cast_id:
+        Identifier of the `cast` function, which must be provided when using
+        a function other than the default one. The identifier must change
+        whenever the results of `cast` change (e.g. ``"myapp.cast/2"``),
+        to invalidate existing cache files.
+    :param cache_path:
+        Path to the cache file. By default, ``.hic`` is appended to `path`.
+    """
+    if cast_id is None:
+        if cast is not _default_cast:
+            raise ValueError("A cast_id is needed for custom cast functions")
+        cast_id = "hipack.cast"
+    if cache_path is None:
+        cache_path = os.fsdecode(path) + ".hic"
+    else:
+        cache_path = os.fsdecode(cache_path)
+
+    with io.open(path, "rb") as f:
+        header = (_CACHE_MAGIC, __version__, os.path.abspath(path),
+                  _stat_signature(os.fstat(f.fileno())), cast_id)
+        try:
+            with io.open(cache_path, "rb") as cache_file:
+                if pickle.load(cache_file) == header:
+                    return pickle.load(cache_file)
+        except Exception:
+            pass  # Missing or invalid cache file: parse the input.
+        result = load(f, cast)
+
+    temp_path = cache_path + "." + str(os.getpid()) + ".tmp"
+    try:
+        with io.open(temp_path, "wb") as cache_file:
+            pickle.dump(header, cache_file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(result, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except Exception:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+    return result
+
+
+class ConfigCache(object):
+    """
+    Keeps parsed messages loaded from files, parsing each file again only
+    when it has been modified, as indicated by its modification time and
+    size.
+
+    :param int maxsize:
+        Maximum number of files kept in the cache. The least recently loaded
+        files are evicted first. (Default: `128`).
+    :param callable cast:
+        A value conversion function, see :class:`Parser` for details.
+    """
+
+    def __init__(self, maxsize=128, cast=cast):
+        assert callable(cast)
+        self.maxsize = maxsize
+        self.cast = cast
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    def _load(self, path):
+        with io.open(path, "rb") as f:
+            signature = _stat_signature(os.fstat(f.fileno()))
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(path)
+                return entry[1], entry[1]
+            value = load(f, self.cast)
+
+        self._entries[path] = (signature, value)
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return (None if entry is None else entry[1]), value
+
+    def load(self, path):
+        """
+        Returns the message contained in a file, parsing it if it is not in
+        the cache, or if it has been modified since it was last parsed.
+        Errors are propagated, and in that case the cache is not modified.
+
+        :param str path:
+            Path to the input file.
+        """
+        return self._load(path)[1]
+
+    def reload(self):
+        """
+        Checks all the files in the cache, and parses again those which have
+        been modified. Errors are propagated, and files which were checked
+        before the error are updated.
+
+        :return:
+            A dictionary which maps the paths of the modified files to the set
+            of top-level keys which were added, removed, or have a different
+            value than before.
+        """
+        changes = {}
+        for path in list(self._entries.keys()):
+            old, new = self._load(path)
+            if old is not new:
+                keys = _changed_keys(old, new)
+                if keys:
+                    changes[path] = keys
+        return changes
+
+    def discard(self, path):
+        """
+        Removes a file from the cache, if present.
+        """
+        self._entries.pop(path, None)
+
+    def clear(self):
+        """
+        Removes all the files from the cache.
+        """
+        self._entries.clear()
+
+
+def _changed_keys(old, new):
+    keys = set(old.keys()).symmetric_difference(new.keys())
+    for k, v in old.items():
+        if k in new and not _equal(v, new[k]):
+            keys.add(k)
+    return frozenset(keys)
+
+
+_SEQUENCE_TYPES = (list, tuple)
+
+
+def _equal(a, b):
+    # Unlike "==", this considers values of different types to be different
+    # (e.g. 1, 1.0 and True), so they are not lost when diffing.
+    pending = [(a, b)]
+    while pending:
+        a, b = pending.pop()
+        if isinstance(a, _MAPPING_TYPES) and isinstance(b, _MAPPING_TYPES):
+            if len(a) != len(b):
+                return False
+            for k, v in a.items():
+                if k not in b:
+                    return False
+                pending.append((v, b[k]))
+        elif isinstance(a, _SEQUENCE_TYPES) and \
+                isinstance(b, _SEQUENCE_TYPES):
+            if len(a) != len(b):
+                return False
+            pending.extend(zip(a, b))
+        elif type(a) is not type(b) or a != b:
+            return False
+    return True
+
+
+def diff(old, new):
+    """
+    Calculates the changes needed to turn a message into another. The result
+    is a list of operations which can be applied using :func:`patch()`.
+
+    Each operation is a dictionary with an ``op`` item, which is one of
+    ``"set"``, ``"delete"`` or ``"insert"``, and a ``path`` item, which is
+    a list of dictionary keys and list indexes leading to the changed value.
+    The ``"set"`` and ``"insert"`` operations also contain a ``value`` item.
+    Operations only use values which can be represented in HiPack, so a
+    patch can be serialized, e.g. ``hipack.dumps({"ops": ops})``.
+
+    :param dict old:
+        Original message.
+    :param dict new:
+        Modified message.
+    """
+    ops = []
+    pending = [((), old, new)]
+    while pending:
+        path, a, b = pending.pop()
+        children = []
+        if isinstance(a, _MAPPING_TYPES) and isinstance(b, _MAPPING_TYPES):
+            for k in sorted(a.keys()):
+                if k not in b:
+                    ops.append({"op": "delete", "path": list(path + (k,))})
+            for k in sorted(b.keys()):
+                if k in a:
+                    children.append((path + (k,), a[k], b[k]))
+                else:
+                    ops.append({"op": "set", "path": list(path + (k,)),
+                                "value": b[k]})
+        elif isinstance(a, _SEQUENCE_TYPES) and \
+                isinstance(b, _SEQUENCE_TYPES):
+            # Skip the common leading and trailing items, so inserting or
+            # removing items in the middle of a list is handled well.
+            start, a_end, b_end = 0, len(a), len(b)
+            while start < a_end and start < b_end and \
+                    _equal(a[start], b[start]):
+                start += 1
+            while a_end > start and b_end > start and \
+                    _equal(a[a_end - 1], b[b_end - 1]):
+                a_end -= 1
+                b_end -= 1
+            common = min(a_end, b_end) - start
+            for i in range(start, start + common):
+                children.append((path + (i,), a[i], b[i]))
+            for i in range(start + common, b_end):
+                ops.append({"op": "insert", "path": list(path + (i,)),
+                            "value": b[i]})
+            for i in reversed(range(start + common, a_end)):
+                ops.append({"op": "delete", "path": list(path + (i,))})
+        elif not _equal(a, b):
+            ops.append({"op": "set", "path": list(path), "value": b})
+        # Children are processed in order, after the operations generated
+        # for their parent.
+        pending.extend(reversed(children))
+    return ops
+
+
+def patch(obj, ops):
+    """
+    Applies a list of operations calculated by :func:`diff()` to a message.
+    The original message is not modified, a new one is returned.
+
+    :param dict obj:
+        Message to which the operations are applied.
+    :param list ops:
+        List of operations.
+    """
+    obj = deepcopy(obj)
+    for op in ops:
+        try:
+            kind, path = op["op"], op["path"]
+        except (KeyError, TypeError):
+            raise ValueError("Invalid patch operation: " + repr(op))
+        if len(path) == 0:
+            if kind != "set" or not isinstance(op.get("value"), dict):
+                raise ValueError("Invalid patch operation: " + repr(op))
+            obj = deepcopy(op["value"])
+            continue
+        try:
+            container = obj
+            for item in path[:-1]:
+                container = container[item]
+            key = path[-1]
+            if kind == "set":
+                container[key] = deepcopy(op["value"])
+            elif kind == "delete":
+                del container[key]
+            elif kind == "insert":
+                if not isinstance(container, list) or \
+                        not 0 <= key <= len(container):
+                    raise IndexError(key)
+                container.insert(key, deepcopy(op["value"]))
+            else:
+                raise ValueError("Invalid patch operation: " + repr(op))
+        except (KeyError, IndexError, TypeError):
+            raise ValueError("Invalid patch path: " + repr(path))
+    return obj
 
 
 if __name__ == "__main__":  ## pragma nocover
@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2024 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the MIT license.
+
+from test.util import *
+import unittest
+import hipack
+
+
+class TestDiff(unittest.TestCase):
+
+    @data((
+        ({}, {}),
+        ({"a": 1}, {"a": 1}),
+        ({"a": 1}, {"a": 2}),
+        ({"a": 1}, {"a": 1.0}),
+        ({"a": 1}, {"a": True}),
+        ({"a": 1}, {}),
+        ({}, {"a": {"b": [1, 2]}}),
+        ({"a": {"b": 1, "c": 2}}, {"a": {"b": 1, "c": 3, "d": 4}}),
+        ({"a": [1, 2, 3]}, {"a": [1, 2, 3, 4, 5]}),
+        ({"a": [1, 2, 3, 4, 5]}, {"a": [1, 2]}),
+        ({"a": [1, 2, 3]}, {"a": [0, 1, 2, 3]}),
+        ({"a": [1, 2, 3]}, {"a": [1, 3]}),
+        ({"a": [1, 2, 3]}, {"a": [4, 5]}),
+        ({"a": [{"x": 1}, {"y": 2}]}, {"a": [{"x": 1}, {"y": 3}]}),
+        ({"a": [1, 2]}, {"a": {"b": 1}}),
+        ({"a": u"Trømso", "b": [[1], [2]]}, {"a": u"☺", "b": [[2], [1]]}),
+    ))
+    def test_roundtrip(self, data):
+        old, new = data
+        ops = hipack.diff(old, new)
+        self.assertEqual(new, hipack.patch(old, ops))
+        # The patch must survive serialization.
+        ops = hipack.loads(hipack.dumps({"ops": ops}))["ops"]
+        result = hipack.patch(old, ops)
+        self.assertEqual(new, result)
+        self.assertTrue(hipack.dumps(new) == hipack.dumps(result))
+
+    def test_no_changes(self):
+        value = {"a": [1, {"b": True}], "c": u"d"}
+        self.assertEqual([], hipack.diff(value, hipack.loads(
+            hipack.dumps(value))))
+
+    def test_compact(self):
+        old = {"k%d" % i: {"v": i} for i in range(100)}
+        new = dict(old, k42={"v": -1})
+        self.assertEqual([{"op": "set", "path": ["k42", "v"], "value": -1}],
+                         hipack.diff(old, new))
+        self.assertEqual(
+            [{"op": "insert", "path": ["l", 1], "value": u"x"}],
+            hipack.diff({"l": [1, 2, 3]}, {"l": [1, u"x", 2, 3]}))
+
+    def test_patch_does_not_modify(self):
+        old = {"a": {"b": [1]}}
+        hipack.patch(old, hipack.diff(old, {"a": {"b": [1, 2]}}))
+        self.assertEqual({"a": {"b": [1]}}, old)
+
+    @data((
+        [{"op": "set"}],
+        [{"path": ["a"]}],
+        [{"op": "frobnicate", "path": ["a"]}],
+        [{"op": "delete", "path": ["missing"]}],
+        [{"op": "set", "path": ["a", "b", "c"], "value": 1}],
+        [{"op": "insert", "path": ["a", 5], "value": 1}],
+        [{"op": "insert", "path": ["d", "x"], "value": 1}],
+        [{"op": "delete", "path": []}],
+    ))
+    def test_patch_invalid(self, ops):
+        with self.assertRaises(ValueError):
+            hipack.patch({"a": [1, 2], "d": {}}, ops)
+
+unpack_data(TestDiff)
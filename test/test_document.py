@@ -0,0 +1,149 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2024 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the MIT license.
+
+from test.util import *
+import unittest
+import hipack
+from os import path
+
+
+class TestDocument(unittest.TestCase):
+
+    text = b"""# Settings
+name: "x"   # The name.
+options {
+\tverbose: True,
+\tlevel: 3  # Level.
+}
+inline: {a: 1, b: 2}
+"""
+
+    def test_get(self):
+        doc = hipack.Document(self.text)
+        self.assertEqual(3, doc.get("options.level"))
+        self.assertEqual(3, doc.get(["options", "level"]))
+        self.assertEqual({"a": 1, "b": 2}, doc.get("inline"))
+        self.assertIn("options.verbose", doc)
+        self.assertNotIn("options.missing", doc)
+        self.assertNotIn("name.missing", doc)
+        with self.assertRaises(KeyError):
+            doc.get("missing")
+        with self.assertRaises(ValueError):
+            doc.get("name.missing")
+        with self.assertRaises(ValueError):
+            doc.get("options..level")
+
+    def test_set_existing(self):
+        doc = hipack.Document(self.text)
+        doc.set("options.level", 5)
+        doc.set("name", u"y")
+        self.assertEqual(self.text.replace(b"3  #", b"5  #")
+                                  .replace(b'"x"', b'"y"'), doc.data)
+
+    def test_set_new(self):
+        doc = hipack.Document(self.text)
+        doc.set("options.items", [1])
+        doc.set("inline.c", 3)
+        doc.set("a.b.c", True)
+        self.assertEqual(b"""# Settings
+name: "x"   # The name.
+options {
+\tverbose: True,
+\tlevel: 3  # Level.
+\titems: [
+\t  1
+\t]
+}
+inline: {a: 1, b: 2 c: 3}
+a: {
+  b: {
+    c: True
+  }
+}
+""", doc.data)
+        self.assertEqual({"name": u"x",
+                          "options": {"verbose": True, "level": 3,
+                                      "items": [1]},
+                          "inline": {"a": 1, "b": 2, "c": 3},
+                          "a": {"b": {"c": True}}},
+                         hipack.loads(doc.data))
+
+    def test_set_empty(self):
+        doc = hipack.Document(b"")
+        doc.set("a", 1)
+        doc.set("b.c", 2)
+        self.assertEqual(b"a: 1\nb: {\n  c: 2\n}\n", doc.data)
+        doc = hipack.Document(b"{a: {}}")
+        doc.set("a.b", 1)
+        self.assertEqual(b"{a: {b: 1}}", doc.data)
+
+    def test_set_value(self):
+        def value(obj):
+            if isinstance(obj, complex):
+                return [obj.real, obj.imag], ["complex"]
+            return hipack.value(obj)
+        doc = hipack.Document(self.text, value=value)
+        doc.set("options.level", 1 + 2j)
+        doc.set("name", u"y")
+        doc.set("inline.c", 3j)
+        doc.set("a.b", 4 + 0j)
+        self.assertIn(b"\tlevel: :complex [\n\t  1.0\n\t  2.0\n\t]  # Level.",
+                      doc.data)
+        self.assertIn(b'name: "y"   # The name.', doc.data)
+        self.assertIn(b"c::complex [0.0,3.0,]", doc.data)
+        self.assertIn(b"b::complex [", doc.data)
+        self.assertEqual([4.0, 0.0], doc.get("a.b"))
+        self.assertEqual([1.0, 2.0], doc.get("options.level"))
+        self.assertEqual([1.0, 2.0],
+                         hipack.loads(doc.data)["options"]["level"])
+
+    def test_set_invalid(self):
+        doc = hipack.Document(self.text)
+        with self.assertRaises(ValueError):
+            doc.set("options.bad key", 1)
+        with self.assertRaises(ValueError):
+            doc.set("name.key", 1)
+        self.assertEqual(self.text, doc.data)
+
+    def test_delete(self):
+        doc = hipack.Document(self.text)
+        doc.delete("options.verbose")
+        doc.delete("inline.a")
+        doc.delete("name")
+        self.assertEqual(b"""# Settings
+options {
+\tlevel: 3  # Level.
+}
+inline: {b: 2}
+""", doc.data)
+        with self.assertRaises(KeyError):
+            doc.delete("name")
+
+    def test_save(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tempdir:
+            filepath = path.join(tempdir, "test.conf")
+            with open(filepath, "wb") as f:
+                f.write(self.text)
+            doc = hipack.Document(filepath)
+            doc.set("inline.b", 20)
+            doc.save()
+            with open(filepath, "rb") as f:
+                self.assertEqual(self.text.replace(b"b: 2", b"b: 20"),
+                                 f.read())
+            doc.delete("inline")
+            doc.save()
+            with open(filepath, "rb") as f:
+                self.assertEqual(self.text[:self.text.index(b"inline")],
+                                 f.read())
+            other = path.join(tempdir, "other.conf")
+            doc.save(other)
+            with open(other, "rb") as f:
+                self.assertEqual(doc.data, f.read())
+        with self.assertRaises(ValueError):
+            hipack.Document(self.text).save()
@@ -11,6 +11,7 @@ import unittest
 import hipack
 from os import path
 from os import listdir
+from io import BytesIO
 
 
 class TestConfigFiles(unittest.TestCase):
@@ -59,4 +60,470 @@ class TestConfigFiles(unittest.TestCase):
                 self.assertEqual(self.heroes[i], hero)
                 i += 1
 
+    def test_unframed_input_generator(self):
+        self.assertEqual([{"a": 1}],
+                         list(hipack.Parser(BytesIO(b"a: 1")).messages()))
+        self.assertEqual([{}], list(hipack.Parser(BytesIO(b"")).messages()))
+
+    corrupted = (b"{ a: 1 }\n"
+                 b"{ b: [1 2 }\n"      # Unterminated list.
+                 b"garbage\n"
+                 b"{ c: \"}{\" }\n"   # Braces inside a string.
+                 b"{ d: 1 e }\n"       # Missing value.
+                 b"# { comment\n"
+                 b"{ f: {g: True} }\n"
+                 b"{ h: ")
+
+    def test_framed_input_recover(self):
+        errors = []
+        parser = hipack.Parser(BytesIO(self.corrupted))
+        messages = list(parser.messages(recover=True, blocksize=5,
+                        on_error=lambda e, start, end:
+                            errors.append((start, end))))
+        self.assertEqual([{"a": 1}, {"c": u"}{"}, {"f": {"g": True}}],
+                         messages)
+        self.assertEqual(4, len(errors))
+        self.assertEqual([self.corrupted[9:20], b"garbage\n",
+                          b"{ d: 1 e }", b"{ h: "],
+                         [self.corrupted[s:e] for (s, e) in errors])
+
+    def test_framed_input_recover_no_callback(self):
+        parser = hipack.Parser(BytesIO(self.corrupted))
+        self.assertEqual([{"a": 1}, {"c": u"}{"}, {"f": {"g": True}}],
+                         list(parser.messages(recover=True, blocksize=5)))
+
+    def test_framed_input_recover_position(self):
+        errors = []
+        parser = hipack.Parser(BytesIO(self.corrupted))
+        list(parser.messages(recover=True, blocksize=5,
+             on_error=lambda e, start, end: errors.append(e)))
+        with self.assertRaises(hipack.ParseError) as expected:
+            list(hipack.Parser(BytesIO(self.corrupted)).messages())
+        self.assertEqual(str(expected.exception), str(errors[0]))
+        self.assertEqual(5, errors[2].line)
+
+    def test_framed_input_recover_after_message(self):
+        parser = hipack.Parser(BytesIO(self.corrupted))
+        self.assertEqual({"a": 1}, parser.parse_message())
+        errors = []
+        messages = list(parser.messages(recover=True,
+                        on_error=lambda e, start, end:
+                            errors.append((start, end))))
+        self.assertEqual([{"c": u"}{"}, {"f": {"g": True}}], messages)
+        self.assertEqual(self.corrupted[9:20],
+                         self.corrupted[errors[0][0]:errors[0][1]])
+
+    def test_framed_input_no_recover(self):
+        with self.assertRaises(hipack.ParseError):
+            list(hipack.Parser(BytesIO(self.corrupted)).messages())
+
+    def test_scan_messages(self):
+        stream = BytesIO(self.corrupted)
+        stream.seek(9)
+        errors = []
+        items = list(hipack.scan_messages(stream, blocksize=5,
+                     on_error=lambda e, start, end:
+                         errors.append((start, end))))
+        self.assertEqual([{"c": u"}{"}, {"f": {"g": True}}],
+                         [message for (_, _, message) in items])
+        for start, end, message in items:
+            self.assertEqual(message,
+                             hipack.loads(self.corrupted[start:end]))
+        self.assertEqual(4, len(errors))
+        with self.assertRaises(hipack.ParseError):
+            list(hipack.scan_messages(BytesIO(self.corrupted)))
+
 TestConfigFiles.setup_tests()
+
+
+class TestLoadCached(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = path.join(self.tempdir.name, "test.conf")
+        self.write({"a": 1, "b": [True, u"☺"]})
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write(self, value, mtime=None):
+        import os
+        with open(self.path, "wb") as f:
+            hipack.dump(value, f)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_cache_is_used(self):
+        value = hipack.load_cached(self.path)
+        self.assertEqual({"a": 1, "b": [True, u"☺"]}, value)
+        self.assertTrue(path.exists(self.path + ".hic"))
+        # Overwrite the cached value: if it is returned, the cache was used.
+        with open(self.path + ".hic", "rb") as f:
+            import pickle
+            header = pickle.load(f)
+        with open(self.path + ".hic", "wb") as f:
+            pickle.dump(header, f)
+            pickle.dump({"cached": True}, f)
+        self.assertEqual({"cached": True}, hipack.load_cached(self.path))
+
+    def test_stale_cache(self):
+        self.write({"a": 1}, mtime=1000000)
+        self.assertEqual({"a": 1}, hipack.load_cached(self.path))
+        self.write({"a": 2}, mtime=2000000)
+        self.assertEqual({"a": 2}, hipack.load_cached(self.path))
+
+    def test_invalid_cache(self):
+        with open(self.path + ".hic", "wb") as f:
+            f.write(b"garbage")
+        self.assertEqual(1, hipack.load_cached(self.path)["a"])
+        self.assertEqual(1, hipack.load_cached(self.path)["a"])
+
+    def test_cast_id(self):
+        def cast(annotations, bytestring, value):
+            return value * 10 if hipack.ANNOT_INT in annotations else value
+        with self.assertRaises(ValueError):
+            hipack.load_cached(self.path, cast)
+        self.assertEqual(1, hipack.load_cached(self.path)["a"])
+        self.assertEqual(10, hipack.load_cached(self.path, cast, "x10/1")["a"])
+        self.assertEqual(1, hipack.load_cached(self.path)["a"])
+
+    def test_cache_path(self):
+        cache_path = path.join(self.tempdir.name, "cache.hic")
+        hipack.load_cached(self.path, cache_path=cache_path)
+        self.assertTrue(path.exists(cache_path))
+        self.assertFalse(path.exists(self.path + ".hic"))
+
+    def test_pathlike(self):
+        from pathlib import Path
+        value = hipack.load_cached(Path(self.path))
+        self.assertEqual({"a": 1, "b": [True, u"☺"]}, value)
+        self.assertTrue(path.exists(self.path + ".hic"))
+        cache_path = Path(self.tempdir.name) / "cache.hic"
+        self.assertEqual(value, hipack.load_cached(self.path,
+                                                   cache_path=cache_path))
+        self.assertTrue(cache_path.exists())
+
+    def test_unwritable_cache(self):
+        cache_path = path.join(self.tempdir.name, "missing", "cache.hic")
+        self.assertEqual(1, hipack.load_cached(self.path,
+                                               cache_path=cache_path)["a"])
+
+
+class TestLoadLazy(unittest.TestCase):
+    text = b"""# Comment
+        a: 1 b: "x#y\\"z" c: :ann [1 {q: "]"} 2]
+        d {e: 1.5, f: [True]} g: 0x1F,h:"s"
+        """
+
+    def test_config_files(self):
+        dirpath = path.abspath(path.dirname(__file__))
+        for filename in listdir(dirpath):
+            if filename.endswith(".conf"):
+                filepath = path.join(dirpath, filename)
+                try:
+                    with open(filepath, "rb") as f:
+                        expected = hipack.load(f)
+                except hipack.ParseError:
+                    continue
+                if expected is not None:
+                    self.assertEqual(expected,
+                                     dict(hipack.load_lazy(filepath)))
+
+    def test_lazy(self):
+        calls = []
+        def cast(annotations, bytestring, value):
+            calls.append(value)
+            return value
+        value = hipack.load_lazy(self.text, cast)
+        self.assertEqual(["a", "b", "c", "d", "g", "h"], list(value))
+        self.assertIn("d", value)
+        self.assertEqual([], calls)
+        self.assertEqual(31, value["g"])
+        self.assertEqual([31], calls)
+        self.assertEqual(31, value["g"])
+        self.assertEqual([31], calls)
+        self.assertEqual(hipack.loads(self.text), dict(value))
+
+    def test_nested(self):
+        value = hipack.load_lazy(b"{a: {b: {c: 1}}}", nested=True)
+        self.assertTrue(isinstance(value["a"], hipack.LazyDict))
+        self.assertTrue(isinstance(value["a"]["b"], hipack.LazyDict))
+        self.assertEqual(1, value["a"]["b"]["c"])
+
+    def test_file(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tempdir:
+            filepath = path.join(tempdir, "test.conf")
+            with open(filepath, "wb") as f:
+                f.write(self.text)
+            value = hipack.load_lazy(filepath)
+            self.assertEqual([1, {"q": "]"}, 2], value["c"])
+            with open(filepath, "wb") as f:
+                pass
+            self.assertEqual(0, len(hipack.load_lazy(filepath)))
+
+    def test_errors(self):
+        value = hipack.load_lazy(b"a: 1\n b: [1\n 2x]")
+        self.assertEqual(1, value["a"])
+        with self.assertRaises(hipack.ParseError) as cm:
+            value["b"]
+        self.assertEqual((3, 5), (cm.exception.line, cm.exception.column))
+        with self.assertRaises(hipack.ParseError):
+            hipack.load_lazy(b"a: [1 2")
+        with self.assertRaises(hipack.ParseError):
+            hipack.load_lazy(b"{a: 1")
+        with self.assertRaises(hipack.ParseError):
+            hipack.load_lazy(b"a: \"abc")
+
+
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.paths = [path.join(self.tempdir.name, "%d.conf" % i)
+                      for i in range(3)]
+        for i, p in enumerate(self.paths):
+            self.write(p, {"index": i, "common": {"x": 1}}, 1000000)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write(self, filepath, value, mtime):
+        import os
+        with open(filepath, "wb") as f:
+            hipack.dump(value, f)
+        os.utime(filepath, (mtime, mtime))
+
+    def test_load(self):
+        cache = hipack.ConfigCache()
+        first = cache.load(self.paths[0])
+        self.assertEqual({"index": 0, "common": {"x": 1}}, first)
+        self.assertIs(first, cache.load(self.paths[0]))
+        self.assertIn(self.paths[0], cache)
+        self.write(self.paths[0], {"index": 10}, 2000000)
+        self.assertEqual({"index": 10}, cache.load(self.paths[0]))
+
+    def test_reload(self):
+        cache = hipack.ConfigCache()
+        for p in self.paths:
+            cache.load(p)
+        self.assertEqual({}, cache.reload())
+        self.write(self.paths[1], {"index": 1, "common": {"x": 2},
+                                   "new": True}, 2000000)
+        # Modified, but with the same contents.
+        self.write(self.paths[2], {"index": 2, "common": {"x": 1}}, 2000000)
+        self.assertEqual({self.paths[1]: frozenset(("common", "new"))},
+                         cache.reload())
+        self.assertEqual({}, cache.reload())
+
+    def test_reload_error(self):
+        cache = hipack.ConfigCache()
+        value = cache.load(self.paths[0])
+        with open(self.paths[0], "wb") as f:
+            f.write(b"invalid: {")
+        with self.assertRaises(hipack.ParseError):
+            cache.reload()
+        import os
+        os.unlink(self.paths[0])
+        with self.assertRaises(OSError):
+            cache.reload()
+        self.assertIn(self.paths[0], cache)
+        cache.discard(self.paths[0])
+        self.assertEqual(0, len(cache))
+
+    def test_eviction(self):
+        cache = hipack.ConfigCache(maxsize=2)
+        for p in self.paths:
+            cache.load(p)
+        self.assertEqual(2, len(cache))
+        self.assertNotIn(self.paths[0], cache)
+        cache.load(self.paths[1])
+        cache.load(self.paths[0])
+        self.assertNotIn(self.paths[2], cache)
+        cache.clear()
+        self.assertEqual(0, len(cache))
+
+
+class TestFollow(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = path.join(self.tempdir.name, "log.hi")
+        open(self.path, "wb").close()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def append(self, *data):
+        with open(self.path, "ab") as f:
+            for item in data:
+                if isinstance(item, dict):
+                    item = hipack.dumps(item, framed=True)
+                f.write(item)
+
+    def test_follow(self):
+        self.append({"n": 1}, {"n": 2}, b"{ n: 3")
+        follower = hipack.follow(self.path, interval=0.01, blocksize=4)
+        offset, message = next(follower)
+        self.assertEqual({"n": 1}, message)
+        with open(self.path, "rb") as f:
+            self.assertEqual(hipack.dumps({"n": 1}, framed=True).rstrip(),
+                             f.read(offset))
+        self.assertEqual({"n": 2}, next(follower)[1])
+        self.append(b" }\n# Comment with a brace: {\n", {"n": u"#}{"})
+        self.assertEqual({"n": 3}, next(follower)[1])
+        self.assertEqual({"n": u"#}{"}, next(follower)[1])
+        follower.close()
+
+    def test_resume(self):
+        self.append({"n": 1}, {"n": 2}, {"n": 3})
+        follower = hipack.follow(self.path, interval=0.01)
+        offset, _ = next(follower)
+        follower.close()
+        follower = hipack.follow(self.path, interval=0.01, offset=offset)
+        self.assertEqual([{"n": 2}, {"n": 3}],
+                         [next(follower)[1], next(follower)[1]])
+        follower.close()
+
+    def test_truncate(self):
+        self.append({"n": 1}, {"n": 2})
+        follower = hipack.follow(self.path, interval=0.01)
+        next(follower)
+        next(follower)
+        with open(self.path, "wb") as f:
+            f.write(hipack.dumps({"n": 3}, False, framed=True))
+        self.assertEqual({"n": 3}, next(follower)[1])
+        follower.close()
+
+    def test_truncate_regrow(self):
+        from unittest import mock
+        self.append({"n": 1}, {"n": 2})
+        follower = hipack.follow(self.path, interval=0.01)
+        next(follower)
+        offset, _ = next(follower)
+        sleep = hipack.time.sleep
+        def rewrite(interval):
+            # The file is truncated and written again past the previous
+            # offset before the next check.
+            with open(self.path, "wb") as f:
+                f.write(hipack.dumps({"n": 3, "s": u"x" * offset}, False,
+                                     framed=True))
+            sleep(interval)
+        with mock.patch("hipack.time.sleep", rewrite):
+            self.assertEqual({"n": 3, "s": u"x" * offset},
+                             next(follower)[1])
+        self.assertGreater(path.getsize(self.path), offset)
+        follower.close()
+
+    def test_rotate(self):
+        import os
+        self.append({"n": 1})
+        follower = hipack.follow(self.path, interval=0.01)
+        next(follower)
+        os.rename(self.path, self.path + ".1")
+        self.append({"n": 2}, {"n": 3})
+        self.assertEqual({"n": 2}, next(follower)[1])
+        self.assertEqual({"n": 3}, next(follower)[1])
+        follower.close()
+
+    def test_rotate_pending(self):
+        import os
+        from unittest import mock
+        self.append({"n": 1})
+        follower = hipack.follow(self.path, interval=0.01)
+        next(follower)
+        stat = os.stat
+        rotated = []
+        def rotate(filepath):
+            # Called after reaching the end of the file: append a message
+            # which is not read yet, then rotate the file.
+            if not rotated:
+                rotated.append(True)
+                self.append({"n": 2})
+                os.rename(self.path, self.path + ".1")
+                self.append({"n": 3})
+            return stat(filepath)
+        with mock.patch("hipack.os.stat", rotate):
+            self.assertEqual({"n": 2}, next(follower)[1])
+        self.assertEqual({"n": 3}, next(follower)[1])
+        follower.close()
+
+    def test_invalid_recover(self):
+        errors = []
+        self.append(b"{ a: 1 }\nnot a message\n{ b: 2 }\n")
+        follower = hipack.follow(self.path, interval=0.01,
+                                 on_error=lambda *args: errors.append(args))
+        self.assertEqual({"a": 1}, next(follower)[1])
+        self.assertEqual({"b": 2}, next(follower)[1])
+        self.assertEqual(1, len(errors))
+        self.assertEqual((9, 23), errors[0][1:])
+        follower.close()
+
+    def test_invalid(self):
+        self.append(b"{ a: 1 }\nnot a message\n{ b: 2 }\n")
+        follower = hipack.follow(self.path, interval=0.01)
+        self.assertEqual({"a": 1}, next(follower)[1])
+        with self.assertRaises(hipack.ParseError):
+            next(follower)
+
+
+class TestCompressed(unittest.TestCase):
+    value = {"a": 1, "b": [True, u"☺"], "c": {"d": u"x" * 1000}}
+
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_roundtrip(self):
+        for extension in ("", ".gz", ".bz2", ".xz", ".lzma"):
+            filepath = path.join(self.tempdir.name, "test.hi" + extension)
+            hipack.dump_file(self.value, filepath)
+            self.assertEqual(self.value, hipack.load_file(filepath))
+            with open(filepath, "rb") as f:
+                data = f.read()
+            if extension:
+                self.assertNotIn(b"xxxx", data)
+            else:
+                self.assertEqual(hipack.dumps(self.value), data)
+
+    def test_detect(self):
+        # Compression is detected by content when reading, not by name.
+        for compression in ("gzip", "bz2", "lzma"):
+            filepath = path.join(self.tempdir.name, compression)
+            hipack.dump_file(self.value, filepath, compression=compression)
+            self.assertEqual(self.value, hipack.load_file(filepath))
+            with open(filepath, "rb") as f:
+                with hipack.open(f) as stream:
+                    self.assertEqual(self.value, hipack.load(stream))
+
+    def test_messages(self):
+        filepath = path.join(self.tempdir.name, "log.hi.gz")
+        with hipack.open(filepath, "w") as f:
+            for n in range(3):
+                hipack.dump({"n": n}, f, framed=True)
+        with hipack.open(filepath, blocksize=4) as f:
+            self.assertEqual([{"n": 0}, {"n": 1}, {"n": 2}],
+                             list(hipack.Parser(f).messages()))
+
+    def test_file_object(self):
+        import bz2
+        stream = BytesIO(hipack.dumps(self.value))
+        self.assertIs(stream, hipack.open(stream, "rb"))
+        stream = BytesIO(bz2.compress(hipack.dumps(self.value)))
+        self.assertEqual(self.value, hipack.load(hipack.open(stream)))
+        with self.assertRaises(ValueError):
+            hipack.open(stream, "rt")
+        with self.assertRaises(ValueError):
+            hipack.open(stream, "rb", compression="zip")
+
+    def test_unseekable_file_object(self):
+        class Reader(object):
+            def __init__(self, data):
+                self.read = BytesIO(data).read
+        stream = Reader(hipack.dumps(self.value))
+        with self.assertRaises(ValueError):
+            hipack.open(stream)
+        self.assertIs(stream, hipack.open(stream, compression=None))
@@ -150,6 +150,7 @@ class TestParser(unittest.TestCase):
             u" another with leading space",
             u"yet one more with trailing space ",
             u"unicode: this → that, Trømso, Java™, ☺",
+            u"# not a comment",
             (u"numeric: \\65\\5d\\5F", u"numeric: e]_"),
             (u"new\\nline", u"new\nline"),
             (u"horizontal\\tab", u"horizontal\tab"),
@@ -333,6 +334,240 @@ class TestParser(unittest.TestCase):
         self.assertEqual(b"a: True\n", stream.getvalue())
 
 
+class TestLimits(unittest.TestCase):
+
+    def check_limit(self, text, limit, **limits):
+        with self.assertRaises(hipack.LimitError) as cm:
+            hipack.loads(text, limits=hipack.Limits(**limits))
+        self.assertEqual(limit, cm.exception.limit)
+        self.assertIsInstance(cm.exception, hipack.ParseError)
+        return cm.exception
+
+    def test_no_limits(self):
+        value = hipack.loads(u"a: [[[1]]] b: \"long string\"",
+                             limits=hipack.Limits())
+        self.assertEqual({"a": [[[1]]], "b": u"long string"}, value)
+
+    def test_max_bytes(self):
+        text = b"a: 1\nb: 2\n"
+        self.check_limit(text, "max_bytes", max_bytes=len(text) - 1)
+        self.assertEqual({"a": 1, "b": 2},
+                         hipack.loads(text, limits=hipack.Limits(
+                             max_bytes=len(text))))
+        with self.assertRaises(hipack.LimitError):
+            hipack.load(BytesIO(text), limits=hipack.Limits(max_bytes=5))
+        self.assertEqual({"a": 1, "b": 2}, hipack.load(
+            BytesIO(text), limits=hipack.Limits(max_bytes=len(text))))
+
+    def test_max_depth(self):
+        self.check_limit(u"a: [[1]]", "max_depth", max_depth=2)
+        self.check_limit(u"a: {b: {}}", "max_depth", max_depth=2)
+        self.assertEqual({"a": [[1]]}, hipack.loads(
+            u"a: [[1]]", limits=hipack.Limits(max_depth=3)))
+        self.check_limit(u"a: " + u"[" * 100000, "max_depth", max_depth=50)
+
+    def test_max_keys(self):
+        self.check_limit(u"a: 1 b: 2 c: 3", "max_keys", max_keys=2)
+        self.check_limit(u"a: {b: 1, c: 2, d: 3}", "max_keys", max_keys=2)
+        self.assertEqual({"a": {"b": 1, "c": 2}}, hipack.loads(
+            u"a: {b: 1, c: 2}", limits=hipack.Limits(max_keys=2)))
+
+    def test_max_string(self):
+        self.check_limit(u"a: \"12345\"", "max_string", max_string=4)
+        self.check_limit(u"abcde: 1", "max_string", max_string=4)
+        self.assertEqual({"abcd": u"1234"}, hipack.loads(
+            u"abcd: \"1234\"", limits=hipack.Limits(max_string=4)))
+
+    def test_recover(self):
+        text = (b"{a: [[1]]}\n{b: 1}\n{c: \"12345\"}\n"
+                b"{d: 1 e: 2 f: 3}\n")
+        limits = hipack.Limits(max_depth=2, max_keys=2, max_string=4)
+        errors = []
+        parser = hipack.Parser(BytesIO(text), limits=limits)
+        self.assertEqual([{"b": 1}], list(parser.messages(recover=True,
+                         on_error=lambda e, start, end:
+                             errors.append(e.limit))))
+        self.assertEqual(["max_depth", "max_string", "max_keys"], errors)
+
+
+class TestStats(unittest.TestCase):
+
+    text = b"a: 1 b: [2.5 True] c: {d: \"e\"}"
+
+    def test_parse_stats(self):
+        stats = hipack.ParseStats()
+        self.assertEqual({"a": 1, "b": [2.5, True], "c": {"d": u"e"}},
+                         hipack.loads(self.text, stats=stats))
+        self.assertEqual(len(self.text), stats.bytes_read)
+        self.assertEqual(len(self.text) + 1, stats.reads)  # Last one is EOF.
+        self.assertEqual({hipack.ANNOT_INT: 1, hipack.ANNOT_FLOAT: 1,
+                          hipack.ANNOT_BOOL: 1, hipack.ANNOT_STRING: 1,
+                          hipack.ANNOT_LIST: 1, hipack.ANNOT_DICT: 1},
+                         stats.values)
+        self.assertEqual(6, stats.casts)
+        self.assertGreaterEqual(stats.cast_time, 0.0)
+        # Counters accumulate.
+        hipack.loads(self.text, stats=stats)
+        self.assertEqual(12, stats.casts)
+        self.assertEqual(len(self.text) * 2, stats.as_dict()["bytes_read"])
+
+    def test_parse_stats_custom_cast(self):
+        def cast(annotations, bytestring, value):
+            return u"x" if hipack.ANNOT_STRING in annotations else value
+        stats = hipack.ParseStats()
+        value = hipack.loads(self.text, cast, stats=stats)
+        self.assertEqual(u"x", value["c"]["d"])
+        self.assertEqual(6, stats.casts)
+
+    def test_dump_stats(self):
+        def value(obj):
+            return obj, None
+        stats = hipack.DumpStats()
+        obj = {"a": 1, "b": [2.5, True], "c": {"d": u"e"}}
+        data = hipack.dumps(obj, stats=stats, value=value)
+        self.assertEqual(len(data), stats.bytes_written)
+        self.assertGreater(stats.writes, 0)
+        self.assertEqual(5, stats.value_calls)  # Message, a, b, c, d.
+        self.assertGreaterEqual(stats.value_time, 0.0)
+        self.assertEqual(sorted(["writes", "bytes_written", "value_calls",
+                                 "value_time"]),
+                         sorted(stats.as_dict().keys()))
+
+
+class TestReformat(unittest.TestCase):
+
+    value = {"a": {"b": [1, {"c": 2.5}, [], u"x\"#"]}, "d": {}, "e": True}
+
+    def reformat(self, data, **kw):
+        output = BytesIO()
+        hipack.reformat(BytesIO(data), output, **kw)
+        return output.getvalue()
+
+    def test_layouts(self):
+        for indent in (True, False):
+            expected = hipack.dumps(self.value, indent)
+            framed = hipack.dumps(self.value, indent, framed=True)
+            for source_indent in (True, False):
+                source = hipack.dumps(self.value, source_indent)
+                for blocksize in (1, 7, 65536):
+                    self.assertEqual(expected,
+                                     self.reformat(source, indent=indent,
+                                                   blocksize=blocksize))
+                source = hipack.dumps(self.value, source_indent, framed=True)
+                self.assertEqual(framed * 3,
+                                 self.reformat(source * 3, indent=indent,
+                                               blocksize=5))
+
+    def test_annotations(self):
+        def value(obj):
+            return obj, (set(("x",)) if obj == 1 else None)
+        source = hipack.dumps({"a": 1}, value=value)
+        self.assertEqual(source, self.reformat(source))
+        self.assertEqual(b"a:[:x 1,] ", self.reformat(b"a [:x 1]",
+                                                      indent=False))
+
+    def test_key_order(self):
+        self.assertEqual(b"b: 1\na: 2\n", self.reformat(b"b:1,a:2"))
+
+    def test_comments(self):
+        source = b"# Head\na: 1 # Tail\nb [ # List\n 1 2\n]\n"
+        self.assertEqual(b"a: 1\nb: [\n  1\n  2\n]\n",
+                         self.reformat(source))
+        self.assertEqual(b"# Head\na: 1\n# Tail\nb: [\n  # List\n  1\n"
+                         b"  2\n]\n", self.reformat(source, comments=True))
+        compact = self.reformat(source, indent=False, comments=True)
+        self.assertEqual(b"# Head\na:1 # Tail\nb:[# List\n1,2,] ", compact)
+        self.assertEqual(hipack.loads(source), hipack.loads(compact))
+
+    @data((b"a: 1 b", b"a: {", b"{a: 1", b"a: \"x", b"a: }", b"a:1 }",
+           b"a 1b:", b"a::"))
+    def test_invalid(self, source):
+        with self.assertRaises(hipack.ParseError):
+            self.reformat(source)
+
+unpack_data(TestReformat)
+
+
+class TestDedupe(unittest.TestCase):
+
+    text = b"""a: "word" b: ["word" "other"] c: {word: 1 x: [1 2]}
+               d: {word: 1 x: [1 2]} e: [1 2] f: [1.0 2] g: [-0.0] h: [0.0]"""
+
+    def test_default(self):
+        value = hipack.loads(self.text)
+        self.assertTrue(isinstance(value, dict))
+        self.assertTrue(isinstance(value["b"], list))
+        self.assertIsNot(value["c"], value["d"])
+
+    def test_strings(self):
+        value = hipack.loads(self.text, dedupe=True)
+        self.assertTrue(isinstance(value["b"], list))
+        self.assertIs(value["a"], value["b"][0])
+        key = [k for k in value["c"] if k == u"word"][0]
+        self.assertIs(value["a"], key)
+        self.assertIsNot(value["c"], value["d"])
+
+    def test_subtrees(self):
+        value = hipack.loads(self.text, dedupe="subtrees")
+        self.assertTrue(isinstance(value, hipack.FrozenDict))
+        self.assertEqual(("word", "other"), value["b"])
+        self.assertIs(value["a"], value["b"][0])
+        self.assertTrue(isinstance(value["c"], hipack.FrozenDict))
+        self.assertIs(value["c"], value["d"])
+        self.assertIs(value["c"]["x"], value["e"])
+        # Values which compare equal but have different types are kept apart.
+        self.assertIsNot(value["e"], value["f"])
+        self.assertIsNot(value["g"], value["h"])
+        self.assertEqual({"word": 1, "x": (1, 2)}, dict(value["c"]))
+        # Results can be dumped back.
+        self.assertEqual(hipack.loads(self.text),
+                         hipack.loads(hipack.dumps(value)))
+
+    def test_frozen(self):
+        value = hipack.loads(self.text, frozen=True)
+        self.assertTrue(isinstance(value, hipack.FrozenDict))
+        self.assertEqual(("word", "other"), value["b"])
+        self.assertTrue(isinstance(value["c"], hipack.FrozenDict))
+        self.assertEqual(value["c"], value["d"])
+        self.assertIsNot(value["c"], value["d"])
+        # Results can be used as dictionary keys.
+        self.assertEqual(1, {value: 1}[hipack.loads(self.text, frozen=True)])
+        self.assertEqual(hipack.loads(self.text),
+                         hipack.loads(hipack.dumps(value)))
+        self.assertEqual({}, hipack.loads(b"", frozen=True))
+
+    def test_recover(self):
+        text = b"{a: \"word\" b: [1]}\n{c: }\n{a: \"word\" b: [1]}\n"
+        messages = list(hipack.Parser(BytesIO(text), dedupe=True)
+                        .messages(recover=True))
+        self.assertEqual(2, len(messages))
+        self.assertIs(messages[0]["a"], messages[1]["a"])
+        messages = list(hipack.Parser(BytesIO(text), frozen=True)
+                        .messages(recover=True))
+        self.assertTrue(isinstance(messages[0], hipack.FrozenDict))
+        self.assertEqual((1,), messages[0]["b"])
+        messages = list(hipack.Parser(BytesIO(text), dedupe="subtrees")
+                        .messages(recover=True))
+        self.assertIs(messages[0]["b"], messages[1]["b"])
+
+    def test_frozen_encoder(self):
+        value = hipack.loads(b"a: {b: 1}", frozen=True)
+        encoder = hipack.Encoder()
+        self.assertEqual(hipack.dumps({"a": {"b": 1}}, False),
+                         encoder.dumps({"a": value["a"]}, False))
+        self.assertEqual(1, len(encoder._cache))
+
+    def test_frozendict(self):
+        d = hipack.FrozenDict({"a": 1, "b": (2, 3)})
+        self.assertEqual({"a": 1, "b": (2, 3)}, d)
+        self.assertEqual(hash(d), hash(hipack.FrozenDict(b=(2, 3), a=1)))
+        self.assertEqual(2, len(d))
+        self.assertIn("a", d)
+        with self.assertRaises(TypeError):
+            d["c"] = 4
+        self.assertEqual({d: 1}[hipack.FrozenDict(d)], 1)
+
+
 class TestDump(unittest.TestCase):
 
     @staticmethod
@@ -363,6 +598,42 @@ class TestDump(unittest.TestCase):
             self.assertEqual(expected, result)
             self.assertTrue(isinstance(result, bytes))
 
+    def test_dump_escapes(self):
+        values = (
+            (u"back\\slash", b'"back\\\\slash"'),
+            (u"new\nline", b'"new\\nline"'),
+            (u"tab\there", b'"tab\\there"'),
+            (u"carriage\return", b'"carriage\\return"'),
+            (u"bell\x07", b'"bell\\07"'),
+            (u"del\x7f", b'"del\\7F"'),
+            (b"bytes\\\n\"", b'"bytes\\\\\\n\\""'),
+        )
+        for value, expected in values:
+            self.assertEqual(expected, self.dump_value(value))
+
+    def test_string_roundtrip(self):
+        import random
+        rng = random.Random(42)
+        alphabet = u"\"\\#:,{}[] \t\r\nabc\x00\x1b\x7f\x80é→☺\U0001F600"
+        strings = [u"", u"#", u"#comment-like", u"\\", u"\""]
+        for _ in range(500):
+            length = rng.randint(0, 20)
+            chars = []
+            for _ in range(length):
+                if rng.random() < 0.5:
+                    chars.append(rng.choice(alphabet))
+                else:
+                    code = rng.randint(0, 0x10FFFF)
+                    if 0xD800 <= code <= 0xDFFF:
+                        code = 0xFFFD  # Surrogates cannot be encoded.
+                    chars.append(chr(code))
+            strings.append(u"".join(chars))
+        for string in strings:
+            for indent in (True, False):
+                data = hipack.dumps({"s": string, "l": [string]}, indent)
+                self.assertEqual({"s": string, "l": [string]},
+                                 hipack.loads(data))
+
     def test_invalid_key_types(self):
         invalid_keys = (
             42, 3.14,    # Numeric.
@@ -406,6 +677,256 @@ class TestDump(unittest.TestCase):
             with self.assertRaises(TypeError):
                 hipack.dumps({ "value": value })
 
+    def test_raw_values(self):
+        values = (
+            (hipack.Raw(b"[1 2 3]"), b"[1 2 3]"),
+            (hipack.Raw(u"\"☺\""), u"\"☺\"".encode("utf-8")),
+            ([hipack.Raw(b"{a:1}")], b"[\n  {a:1}\n]"),
+        )
+        for value, expected in values:
+            self.assertEqual(expected, self.dump_value(value))
+        self.assertEqual(b"a:{b:True} ",
+                         hipack.dumps({"a": hipack.Raw(b"{b:True}")}, False))
+
+    def test_raw_validate(self):
+        self.assertEqual(b"42", hipack.Raw(b" 42 ", validate=True).data.strip())
+        for data in (b"", b"foo", b"[1 2", b"1 2", b"{a:1}}"):
+            with self.assertRaises(hipack.ParseError):
+                hipack.Raw(data, validate=True)
+        with self.assertRaises(TypeError):
+            hipack.Raw(42)
+
+
+class TestDumpNesting(unittest.TestCase):
+
+    @staticmethod
+    def nested(depth, leaf=True):
+        value = leaf
+        for i in range(depth):
+            value = [value] if i % 2 else {"k": value}
+        return value
+
+    def test_deep_nesting(self):
+        import sys
+        depth = sys.getrecursionlimit() * 2
+        value = {"root": self.nested(depth)}
+        for indent in (True, False):
+            data = hipack.dumps(value, indent)
+            self.assertTrue(data.startswith(b"root:"))
+            self.assertEqual(depth, data.count(b"[") + data.count(b"{"))
+
+    def test_same_output(self):
+        value = {"root": self.nested(6)}
+        self.assertEqual(
+            b"root:[{k:[{k:[{k:True },] },] },] ", hipack.dumps(value, False))
+        self.assertEqual(hipack.loads(hipack.dumps(value)), value)
+
+    def test_max_depth(self):
+        value = {"root": self.nested(9)}
+        hipack.dumps(value, max_depth=10)
+        with self.assertRaises(ValueError):
+            hipack.dumps(value, max_depth=9)
+        with self.assertRaises(ValueError):
+            hipack.dumps({"a": {}}, max_depth=1)
+        hipack.dumps({"a": 1}, max_depth=1)
+
+    def test_circular_reference(self):
+        items = [1, 2]
+        items.append(items)
+        with self.assertRaises(ValueError):
+            hipack.dumps({"items": items})
+        d = {}
+        d["self"] = d
+        with self.assertRaises(ValueError):
+            hipack.dumps(d)
+
+    def test_shared_reference(self):
+        shared = [1, 2]
+        self.assertEqual(b"a:[1,2,] b:[[1,2,],[1,2,],] ",
+                         hipack.dumps({"a": shared, "b": [shared, shared]},
+                                      False))
+
+
+class TestCanonical(unittest.TestCase):
+
+    def test_sets(self):
+        words = [u"delta", u"alpha", u"charlie", u"bravo", u"echo"]
+        a = {"s": set(words), "f": frozenset([1.5, 2, u"x"])}
+        b = {"f": frozenset([u"x", 2, 1.5]), "s": set(reversed(words))}
+        self.assertEqual(hipack.canonical_dumps(a), hipack.canonical_dumps(b))
+        self.assertEqual(
+            b's:["alpha","bravo","charlie","delta","echo",] ',
+            hipack.canonical_dumps({"s": set(words)}))
+
+    def test_annotations(self):
+        def annotate(annots):
+            def value(obj):
+                if obj == 42:
+                    return obj, annots
+                return obj, None
+            return value
+        a = hipack.canonical_dumps({"v": 42}, annotate(["b", "a", "c"]))
+        b = hipack.canonical_dumps({"v": 42}, annotate(("c", "a", "b")))
+        self.assertEqual(b"v::a:b:c 42 ", a)
+        self.assertEqual(a, b)
+
+    def test_floats(self):
+        self.assertEqual(b"f:0.1 g:1e+16 h:-0.0 ",
+                         hipack.canonical_dumps({"f": 0.1, "g": 1e16,
+                                                 "h": -0.0}))
+        for f in (float("nan"), float("inf"), float("-inf")):
+            with self.assertRaises(ValueError):
+                hipack.canonical_dumps({"f": f})
+
+    def test_roundtrip(self):
+        value = {"a": [1, 2.5, {"b": u"☺"}], "c": True}
+        self.assertEqual(value, hipack.loads(hipack.canonical_dumps(value)))
+
+    def test_digest(self):
+        import hashlib
+        value = {"s": {3, 1, 2}, "d": {"x": [1.25, u"Trømso"]}}
+        data = hipack.canonical_dumps(value)
+        self.assertEqual(hashlib.sha256(data).hexdigest(),
+                         hipack.digest(value))
+        self.assertEqual(hashlib.md5(data).hexdigest(),
+                         hipack.digest(value, "md5"))
+        self.assertEqual(hipack.digest(value),
+                         hipack.digest({"d": {"x": (1.25, u"Trømso")},
+                                        "s": {2, 3, 1}}))
+        self.assertNotEqual(hipack.digest(value), hipack.digest({"s": 1}))
+
+
+class TestDumpsInto(unittest.TestCase):
+
+    value = {"a": [1, 2.5, True], "b": {"c": u"Trømso"}}
+
+    def test_bytearray(self):
+        for indent in (True, False):
+            expected = hipack.dumps(self.value, indent)
+            buf = bytearray()
+            self.assertEqual(len(expected),
+                             hipack.dumps_into(self.value, buf, indent=indent))
+            self.assertEqual(expected, bytes(buf))
+
+    def test_offset(self):
+        expected = hipack.dumps(self.value)
+        buf = bytearray(b"HEADER")
+        n = hipack.dumps_into(self.value, buf, offset=6)
+        self.assertEqual(b"HEADER" + expected, bytes(buf))
+        self.assertEqual(len(expected), n)
+        with self.assertRaises(ValueError):
+            hipack.dumps_into(self.value, buf, offset=len(buf) + 1)
+
+    def test_memoryview(self):
+        expected = hipack.dumps(self.value)
+        size = hipack.dumped_size(self.value)
+        self.assertEqual(len(expected), size)
+        buf = bytearray(size + 4)
+        n = hipack.dumps_into(self.value, memoryview(buf), offset=2)
+        self.assertEqual(size, n)
+        self.assertEqual(expected, bytes(buf[2:2 + n]))
+
+    def test_overflow(self):
+        size = hipack.dumped_size(self.value)
+        with self.assertRaises(BufferError):
+            hipack.dumps_into(self.value, memoryview(bytearray(size - 1)))
+        buf = bytearray(size - 1)
+        with self.assertRaises(BufferError):
+            hipack.dumps_into(self.value, buf, grow=False)
+        self.assertEqual(size - 1, len(buf))
+
+    def test_readonly(self):
+        with self.assertRaises(TypeError):
+            hipack.dumps_into(self.value, b"immutable")
+
+
+class TestFramed(unittest.TestCase):
+
+    messages = [{"n": i, "name": u"msg%d" % i, "l": [i, {"x": True}]}
+                for i in range(10)]
+
+    def test_dumps_framed(self):
+        self.assertEqual(b"{a:1 }\n", hipack.dumps({"a": 1}, False,
+                                                  framed=True))
+        self.assertEqual(b"{\n  a: 1\n}\n", hipack.dumps({"a": 1},
+                                                        framed=True))
+        for indent in (True, False):
+            data = b"".join(hipack.dumps(m, indent, framed=True)
+                            for m in self.messages)
+            self.assertEqual(self.messages,
+                             list(hipack.Parser(BytesIO(data)).messages()))
+
+    def test_dumps_batch(self):
+        expected = b"".join(hipack.dumps(m, False, framed=True)
+                            for m in self.messages)
+        for workers in (1, 2):
+            self.assertEqual(expected, hipack.dumps_batch(
+                self.messages, workers=workers, chunksize=3))
+
+    def test_dumps_batch_stream(self):
+        output = BytesIO()
+        self.assertIsNone(hipack.dumps_batch(iter(self.messages), output,
+                                             workers=2, indent=True))
+        output.seek(0)
+        self.assertEqual(self.messages,
+                         list(hipack.Parser(output).messages()))
+
+    def test_dumps_batch_unpicklable_value(self):
+        with self.assertRaises(TypeError):
+            hipack.dumps_batch(self.messages, workers=2,
+                               value=lambda obj: (obj, None))
+
+
+class TestEncoder(unittest.TestCase):
+
+    shared = (hipack.FrozenDict(name="service", ports=(80, 443)), "extra")
+    value = {"a": shared, "b": [shared, 1], "c": {"d": shared}}
+
+    def test_same_output(self):
+        encoder = hipack.Encoder()
+        for indent in (True, False):
+            expected = hipack.dumps(self.value, indent)
+            self.assertEqual(expected, encoder.dumps(self.value, indent))
+            # Second round uses the cached sub-trees.
+            self.assertEqual(expected, encoder.dumps(self.value, indent))
+
+    def test_cache_reuse(self):
+        calls = []
+        def counting_value(obj):
+            calls.append(obj)
+            return obj, None
+        encoder = hipack.Encoder(counting_value)
+        encoder.dumps(self.value)
+        ncalls = len(calls)
+        del calls[:]
+        encoder.dumps(self.value)
+        self.assertLess(len(calls), ncalls)
+
+    def test_cache_eviction(self):
+        encoder = hipack.Encoder(cache_size=2)
+        items = [(i,) for i in range(5)]
+        encoder.dumps({"items": items}, False)
+        self.assertEqual(2, len(encoder._cache))
+        encoder.clear()
+        self.assertEqual(0, len(encoder._cache))
+
+    def test_mutable_contents(self):
+        shared = ({"port": 80}, (1, [2]))
+        encoder = hipack.Encoder()
+        self.assertEqual(hipack.dumps({"a": shared}),
+                         encoder.dumps({"a": shared}))
+        shared[0]["port"] = 9999
+        shared[1][1].append(3)
+        self.assertEqual(hipack.dumps({"a": shared}),
+                         encoder.dumps({"a": shared}))
+        self.assertEqual(0, len(encoder._cache))
+
+    def test_no_cache(self):
+        encoder = hipack.Encoder(cache_size=0)
+        self.assertEqual(hipack.dumps(self.value), encoder.dumps(self.value))
+        self.assertEqual(0, len(encoder._cache))
+
+
 unpack_data(TestParser)
 
 
@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2024 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the MIT license.
+
+from test.util import *
+import unittest
+import hipack
+from io import BytesIO
+
+
+class TestQuery(unittest.TestCase):
+
+    document = b"""services {
+        web {port: 80, host: "a"}  # Comment with a brace: {
+        db {port: 5432 tags: ["x" "]" "y"]}
+    }
+    other: [1 {port: 3}]
+    """
+
+    logs = (b"{level: \"error\" msg: \"a\" n: 1 extra: {x: [1 2]}}\n"
+            b"{level: \"info\" msg: \"b\" n: 2}\n"
+            b"{level: \"error\" msg: \"c\" n: 3 retried: True}\n")
+
+    def query(self, data, path=None, where=None):
+        return list(hipack.Query(path, where).select(BytesIO(data),
+                                                     blocksize=5))
+
+    @data((
+        ("services.*.port", [80, 5432]),
+        ("services.db.tags.2", [u"y"]),
+        ("other.1.port", [3]),
+        ("*.*.port", [80, 5432, 3]),
+        ("services.web", [{"port": 80, "host": u"a"}]),
+        ("services.web.missing", []),
+        ("missing.key", []),
+    ))
+    def test_path(self, item):
+        path, expected = item
+        self.assertEqual(expected, self.query(self.document, path))
+
+    def test_whole_message(self):
+        self.assertEqual([hipack.loads(self.document)],
+                         self.query(self.document, "."))
+        self.assertEqual([hipack.loads(self.document)],
+                         self.query(self.document))
+
+    def test_overlapping_paths(self):
+        self.assertEqual([5432], self.query(self.document, "services.db.port",
+                                            "services.*.port == 80"))
+        self.assertEqual([80, 5432],
+                         self.query(self.document, "services.*.port",
+                                    "services.db.port == 5432"))
+        # The value at the path is parsed, and contains the filter value.
+        self.assertEqual([{"port": 5432, "tags": [u"x", u"]", u"y"]}],
+                         self.query(self.document, "services.db",
+                                    "services.db.tags.0 == \"x\""))
+
+    def test_where(self):
+        messages = list(hipack.Parser(BytesIO(self.logs)).messages())
+        self.assertEqual([messages[0], messages[2]],
+                         self.query(self.logs, where='level == "error"'))
+        self.assertEqual([u"a"], self.query(self.logs, "msg",
+                         'level == "error" and not retried'))
+        self.assertEqual([1, 2, 3], self.query(self.logs, "n",
+                         'n >= 2 or (msg == "a")'))
+        self.assertEqual([2], self.query(self.logs, "n", "n != 1 and n < 3"))
+        self.assertEqual([1], self.query(self.logs, "n", "extra.x.* == 2"))
+        # Values of different types are never ordered.
+        self.assertEqual([], self.query(self.logs, "n", "level > 3"))
+
+    @data((
+        "a ==",
+        "(a",
+        "a == b",
+        "a == 1 b",
+        "and",
+        "a == \"x",
+    ))
+    def test_invalid_where(self, where):
+        with self.assertRaises(ValueError):
+            hipack.Query(where=where)
+
+    def test_invalid_path(self):
+        with self.assertRaises(ValueError):
+            hipack.Query("a..b")
+
+    @data((
+        b"a: {x: [1\n 2] y: \"#}\"} b: 1x",
+        b"a: [{x:\n1}]   # Comment\n\n  b: 1x",
+        b"{a: {x: 1}} {b: 1x}",
+    ))
+    def test_error_position(self, data):
+        with self.assertRaises(hipack.ParseError) as expected:
+            list(hipack.Parser(BytesIO(data)).messages())
+        with self.assertRaises(hipack.ParseError) as result:
+            self.query(data, "b")
+        self.assertEqual(str(expected.exception), str(result.exception))
+
+    def test_unterminated(self):
+        with self.assertRaises(hipack.ParseError):
+            self.query(b"a: {b: [1 2", "c")
+
+unpack_data(TestQuery)
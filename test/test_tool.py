@@ -0,0 +1,243 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © 2024 Adrian Perez <aperez@igalia.com>
+#
+# Distributed under terms of the MIT license.
+
+import unittest
+import hipack
+import os
+import subprocess
+import sys
+import tempfile
+from os import path
+
+TOPDIR = path.dirname(path.dirname(path.abspath(__file__)))
+TOOL = path.join(TOPDIR, "hipack")
+
+
+class ToolTestCase(unittest.TestCase):
+    """
+    Runs the "hipack" tool as a separate process, in a temporary directory.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dir = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write(self, name, data):
+        filepath = path.join(self.dir, name)
+        with open(filepath, "wb") as f:
+            f.write(data)
+        return filepath
+
+    def read(self, name):
+        with open(path.join(self.dir, name), "rb") as f:
+            return f.read()
+
+    def run_tool(self, *args, **kwargs):
+        env = dict(os.environ, PYTHONPATH=TOPDIR)
+        return subprocess.run([sys.executable, TOOL] + list(args),
+                              input=kwargs.get("input", b""),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              cwd=self.dir, env=env, timeout=60)
+
+
+class TestConvert(ToolTestCase):
+
+    def test_convert(self):
+        self.write("a.json", b'{"a": [1, 2], "b": "x"}')
+        self.write("b.json", b'{"c": {"d": true}}')
+        os.mkdir(path.join(self.dir, "out"))
+        result = self.run_tool("convert", "-o", "out", "a.json", "b.json")
+        self.assertEqual(0, result.returncode)
+        self.assertIn(b"2 files converted: 2 succeeded, 0 failed",
+                      result.stderr)
+        self.assertEqual({"a": [1, 2], "b": u"x"},
+                         hipack.loads(self.read("out/a.hipack")))
+        self.assertEqual({"c": {"d": True}},
+                         hipack.loads(self.read("out/b.hipack")))
+
+    def test_convert_parallel(self):
+        names = []
+        for i in range(8):
+            names.append(path.basename(self.write("m%d.hipack" % i,
+                         hipack.dumps({"n": i}))))
+        names.append(self.write("bad.hipack", b"a: [1"))
+        os.mkdir(path.join(self.dir, "out"))
+        result = self.run_tool("convert", "-j", "3", "-o", "out",
+                               "-f", "hipack", "-t", "jsonl", *names)
+        self.assertEqual(1, result.returncode)
+        self.assertIn(b"9 files converted: 8 succeeded, 1 failed",
+                      result.stderr)
+        self.assertIn(b"bad.hipack:", result.stderr)
+        for i in range(8):
+            self.assertEqual(b'{"n":' + str(i).encode() + b'}\n',
+                             self.read("out/m%d.jsonl" % i))
+        # Output of files which failed is removed.
+        self.assertFalse(path.exists(path.join(self.dir, "out/bad.jsonl")))
+
+    def test_convert_invalid(self):
+        self.write("a.json", b"{}")
+        result = self.run_tool("convert", "-o", "missing", "a.json")
+        self.assertNotEqual(0, result.returncode)
+        self.assertIn(b"No such directory", result.stderr)
+        os.mkdir(path.join(self.dir, "out"))
+        result = self.run_tool("convert", "-o", "out", "-t", "bad", "a.json")
+        self.assertNotEqual(0, result.returncode)
+        self.assertIn(b"No such format: bad", result.stderr)
+        result = self.run_tool("convert", "-o", "out", "a.json", "x/a.json")
+        self.assertNotEqual(0, result.returncode)
+        self.assertIn(b"would be converted to", result.stderr)
+
+
+    def test_convert_input_as_output(self):
+        data = hipack.dumps({"a": 1})
+        self.write("x.hipack", data)
+        os.mkdir(path.join(self.dir, "sub"))
+        self.write("sub/y.hipack", data)
+        self.write("sub/x.hipack", data)
+        for args in (("-t", "hipack", "-o", ".", "x.hipack"),
+                     ("-t", "hipack-compact", "-o", "sub", "sub/y.hipack"),
+                     ("-t", "hipack", "-o", "sub", "x.hipack",
+                      "sub/x.hipack")):
+            result = self.run_tool("convert", "-f", "hipack", *args)
+            self.assertNotEqual(0, result.returncode)
+            self.assertIn(b"which is an input file", result.stderr)
+        self.assertEqual(data, self.read("x.hipack"))
+        self.assertEqual(data, self.read("sub/y.hipack"))
+        self.assertEqual(data, self.read("sub/x.hipack"))
+
+    def test_convert_keeps_previous_output(self):
+        self.write("a.json", b"{")
+        os.mkdir(path.join(self.dir, "out"))
+        self.write("out/a.hipack", b"a: 1\n")
+        result = self.run_tool("convert", "-o", "out", "a.json")
+        self.assertEqual(1, result.returncode)
+        self.assertEqual(b"a: 1\n", self.read("out/a.hipack"))
+        self.assertEqual(["a.hipack"], os.listdir(path.join(self.dir, "out")))
+
+
+class TestCheck(ToolTestCase):
+
+    def test_check(self):
+        self.write("a.hipack", b"a: 1")
+        self.write("b.hipack", b"{a: 1} {b: 2}")
+        result = self.run_tool("check", "a.hipack", "b.hipack")
+        self.assertEqual(0, result.returncode)
+        self.assertIn(b"2 files checked: 2 succeeded, 0 failed",
+                      result.stderr)
+
+    def test_check_invalid(self):
+        self.write("a.hipack", b"a: 1")
+        self.write("b.hipack", b"a: [1\nb: 2x")
+        for jobs in ("1", "0"):
+            result = self.run_tool("check", "-j", jobs, "a.hipack",
+                                   "b.hipack", "missing.hipack")
+            self.assertEqual(1, result.returncode)
+            self.assertIn(b"3 files checked: 1 succeeded, 2 failed",
+                          result.stderr)
+            self.assertIn(b"b.hipack:2:", result.stderr)
+            self.assertIn(b"missing.hipack: FileNotFoundError",
+                          result.stderr)
+
+
+class TestBench(ToolTestCase):
+
+    def test_bench(self):
+        self.write("a.hipack", b"{a: 1 b: [1 2]}\n{a: 2 b: []}\n")
+        result = self.run_tool("bench", "-n", "2", "a.hipack")
+        self.assertEqual(0, result.returncode)
+        lines = result.stdout.decode("utf-8").splitlines()
+        self.assertIn("2 messages, 2 iterations", lines[0])
+        self.assertEqual(["phase", "load", "dump", "dump-compact"],
+                         [line.split()[0] for line in lines[1:]])
+
+    def test_bench_invalid(self):
+        self.write("a.hipack", b"a: [1")
+        result = self.run_tool("bench", "a.hipack")
+        self.assertEqual(1, result.returncode)
+        self.assertIn(b"a.hipack:", result.stderr)
+        result = self.run_tool("bench", "-n", "0", "a.hipack")
+        self.assertEqual(1, result.returncode)
+        self.assertIn(b"must be positive", result.stderr)
+        result = self.run_tool("bench", "missing.hipack")
+        self.assertEqual(1, result.returncode)
+        self.assertIn(b"missing.hipack: FileNotFoundError", result.stderr)
+        self.assertNotIn(b"Traceback", result.stderr)
+
+
+class TestStats(ToolTestCase):
+
+    def test_stats(self):
+        self.write("a.hipack",
+                   b"{a: 1 b: [\"x\" \"yyy\"]}\n{c: {d: 1.5}}\n")
+        result = self.run_tool("stats", "a.hipack")
+        self.assertEqual(0, result.returncode)
+        output = result.stdout.decode("utf-8")
+        rows = dict(line.rsplit(None, 1) for line in output.splitlines()
+                    if line and not line.endswith(":"))
+        self.assertEqual("2", rows["messages"])
+        self.assertEqual("4", rows["dictionary items"])
+        self.assertEqual("2", rows["max depth"])
+        self.assertEqual("2", rows["string"])
+        self.assertEqual("1", rows["2-3"])
+
+    def test_stats_invalid(self):
+        self.write("a.hipack", b"{a: 1} {b: }")
+        result = self.run_tool("stats", "a.hipack")
+        self.assertEqual(1, result.returncode)
+        self.assertIn(b"a.hipack:1:", result.stderr)
+        result = self.run_tool("stats", "missing.hipack")
+        self.assertEqual(1, result.returncode)
+        self.assertIn(b"missing.hipack: FileNotFoundError", result.stderr)
+        self.assertNotIn(b"Traceback", result.stderr)
+
+
+class TestQueryCommand(ToolTestCase):
+
+    logs = b"{a: {b: 1}}\n{a: {b: [2]}}\n"
+
+    def test_query(self):
+        self.write("logs.hipack", self.logs)
+        result = self.run_tool("query", "a.b", "logs.hipack")
+        self.assertEqual(0, result.returncode)
+        self.assertEqual(b"1\n[2]\n", result.stdout)
+        result = self.run_tool("query", "a.b", input=self.logs)
+        self.assertEqual(b"1\n[2]\n", result.stdout)
+        result = self.run_tool("query", "a.b", "-t", "jsonl", "logs.hipack",
+                               "-", input=self.logs)
+        self.assertEqual(b"1\n[2]\n1\n[2]\n", result.stdout)
+        result = self.run_tool("query", "a.b", "logs.hipack", "--bad")
+        self.assertEqual(2, result.returncode)
+        self.assertIn(b"unrecognized arguments: --bad", result.stderr)
+
+    def test_path_option(self):
+        self.write("logs.hipack", self.logs)
+        result = self.run_tool("query", "-w", "a.b == 1", "-p", ".",
+                               "logs.hipack")
+        self.assertEqual(b'{"a":{"b":1}}\n', result.stdout)
+        # Without --path the first argument is always the path, even if
+        # there is a file with the same name.
+        self.write("a.b", b"")
+        result = self.run_tool("query", "a.b", "logs.hipack")
+        self.assertEqual(b"1\n[2]\n", result.stdout)
+
+    def test_framed_output(self):
+        self.write("logs.hipack", self.logs)
+        result = self.run_tool("query", "a", "-t", "hipack-framed",
+                               "logs.hipack")
+        self.assertEqual(0, result.returncode)
+        self.assertEqual([{"b": 1}, {"b": [2]}],
+                         [hipack.loads(line)
+                          for line in result.stdout.splitlines()])
+        result = self.run_tool("query", "a.b", "-t", "hipack-framed",
+                               "logs.hipack")
+        self.assertEqual(1, result.returncode)
+        self.assertIn(b"logs.hipack: selected value 1 is not a dictionary",
+                      result.stderr)